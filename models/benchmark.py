@@ -0,0 +1,194 @@
+from typing import Callable, Sequence
+import time
+import numpy as np
+import pandas as pd
+import scipy
+
+from sampling import sample_normal_growth_rate, sample_symmetric_levy_stable, sample_levy_stable_growth_rate
+from utils import get_annualized_growth_rate
+from lumps import LumpSampler, ScalarLumpSampler
+from models import DurantonModel, GabaixModel
+
+
+def _synthetic_curves():
+    # Smooth curves on the same support as the fitted ones, so that the benchmarks do not need the database
+    x = np.logspace(start=2, stop=7, num=100, base=10)
+
+    def mean_growth_rate(size):
+        return np.interp(size, x, 0.02 - 0.002 * np.log10(x))
+
+    def std_growth_rate(size):
+        return np.interp(size, x, 0.2 / np.log10(x))
+
+    return mean_growth_rate, std_growth_rate
+
+
+def _time(func: Callable, repeat: int = 3) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    return min(timings)
+
+
+def benchmark_normal_growth_rate(sizes: Sequence[int] = (10 ** 4, 10 ** 5, 10 ** 6), seed: int = 0) -> None:
+    mean_growth_rate, std_growth_rate = _synthetic_curves()
+
+    def per_city_growth_rate(pop):
+        growth_rate = 1 + np.array([np.random.normal(loc=mean_growth_rate(p), scale=std_growth_rate(p)) for p in pop])
+        return np.clip(growth_rate, 0, np.inf)
+
+    for size in sizes:
+        pop = np.random.lognormal(mean=8, sigma=1.5, size=size)
+
+        np.random.seed(seed)
+        expected = per_city_growth_rate(pop)
+        np.random.seed(seed)
+        actual = sample_normal_growth_rate(pop=pop, mean_growth_rate=mean_growth_rate, std_growth_rate=std_growth_rate)
+        assert np.array_equal(expected, actual), 'Batched growth rates differ from the per-city ones'
+
+        t_loop = _time(lambda: per_city_growth_rate(pop), repeat=1)
+        t_batched = _time(lambda: sample_normal_growth_rate(pop=pop, mean_growth_rate=mean_growth_rate, std_growth_rate=std_growth_rate))
+        print(f'normal growth rate, n={size}: per-city {t_loop:.3f}s, batched {t_batched:.4f}s, speedup x{t_loop / t_batched:.0f}')
+
+
+def check_levy_stable_sampler(alphas: Sequence[float] = (1.0, 1.25, 1.5, 1.75, 2.0), n: int = 10 ** 5, seed: int = 0, significance: float = 0.001) -> None:
+    # Two-sample Kolmogorov-Smirnov test of the Chambers-Mallows-Stuck sampler against scipy's levy_stable
+    np.random.seed(seed)
+    for alpha in alphas:
+        loc, scale = 0.01, 0.1
+        actual = sample_symmetric_levy_stable(alpha=np.full(n, alpha), loc=loc, scale=scale)
+        expected = scipy.stats.levy_stable.rvs(alpha=alpha, beta=0, loc=loc, scale=scale, size=n)
+        res = scipy.stats.ks_2samp(actual, expected)
+        print(f'levy stable, alpha={alpha}: KS statistic {res.statistic:.4f}, p-value {res.pvalue:.3f}')
+        assert res.pvalue > significance, f'Stable sampler does not match scipy for alpha={alpha}'
+
+
+def benchmark_levy_stable_growth_rate(sizes: Sequence[int] = (10 ** 4, 10 ** 5, 10 ** 6), n_per_city: int = 10 ** 3) -> None:
+    mean_growth_rate, std_growth_rate = _synthetic_curves()
+
+    def shock_exponent(size):
+        return np.where(np.asarray(size) < 5 * 10 ** 3, 1.25, 1.5)
+
+    # The per-city scipy sampler is timed on a small population and extrapolated, as it takes minutes on the large ones
+    pop = np.random.lognormal(mean=8, sigma=1.5, size=n_per_city)
+    t_per_city = _time(lambda: [scipy.stats.levy_stable.rvs(alpha=shock_exponent(p), beta=0, loc=mean_growth_rate(p), scale=std_growth_rate(p)) for p in pop], repeat=1) / n_per_city
+    for size in sizes:
+        pop = np.random.lognormal(mean=8, sigma=1.5, size=size)
+        t_batched = _time(lambda: sample_levy_stable_growth_rate(pop=pop, mean_growth_rate=mean_growth_rate, std_growth_rate=std_growth_rate, shock_exponent=shock_exponent))
+        print(f'levy stable growth rate, n={size}: per-city (extrapolated) {t_per_city * size:.1f}s, batched {t_batched:.4f}s, speedup x{t_per_city * size / t_batched:.0f}')
+
+
+def _synthetic_multirun(n_rows: int, n_years: int = 10, seed: int = 0) -> pd.DataFrame:
+    # Multirun-like frame with n_years rows per (run, cluster_uid), some of the clusters starting later, shuffled as a union of queries would be
+    rng = np.random.default_rng(seed)
+    n_clusters = n_rows // n_years
+    run, cluster_uid = np.divmod(np.arange(n_clusters), 10 ** 4)
+    start = rng.integers(0, n_years // 2, size=n_clusters) * (rng.random(n_clusters) < 0.2)
+    year = np.repeat(start, n_years) + np.tile(np.arange(n_years), n_clusters)
+    traj = pd.DataFrame({'year': 1850 + 10 * year, 'cluster_uid': np.repeat(cluster_uid, n_years), 'population': rng.lognormal(mean=8, sigma=1.5, size=n_clusters * n_years),
+                         'run': np.repeat(run, n_years)})
+    return traj.sample(frac=1, random_state=seed, ignore_index=True)
+
+
+def benchmark_annualized_growth_rate(n_rows: int = 10 ** 7, n_groupby: int = 10 ** 5) -> None:
+    def groupby_growth_rate(traj):
+        # Previous implementation, with ydiff computed within each group so that it can be compared at the group boundaries
+        traj = traj.sort_values(by=['run', 'cluster_uid', 'year'])
+        traj['growth_rate'] = traj.groupby(['run', 'cluster_uid'])['population'].transform(lambda x: np.nan if len(x) < 2 else -1 * x.diff(-1) / x)
+        ydiff = -1 * traj.groupby(['run', 'cluster_uid'])['year'].diff(-1)
+        traj['annualized_growth_rate'] = np.power(1 + traj['growth_rate'], 1 / ydiff) - 1
+        return traj
+
+    traj = _synthetic_multirun(n_rows=n_groupby)
+    expected, actual = groupby_growth_rate(traj), get_annualized_growth_rate(traj)
+    assert np.allclose(expected['annualized_growth_rate'], actual['annualized_growth_rate'], equal_nan=True, rtol=1e-12), 'Vectorized growth rates differ from the groupby ones'
+
+    # The groupby version is timed on a smaller frame and extrapolated, as it takes minutes on the large one
+    t_groupby = _time(lambda: groupby_growth_rate(traj), repeat=1) * n_rows / n_groupby
+    traj = _synthetic_multirun(n_rows=n_rows)
+    t_vectorized = _time(lambda: get_annualized_growth_rate(traj), repeat=1)
+    print(f'annualized growth rate, n={n_rows}: groupby (extrapolated) {t_groupby:.1f}s, vectorized {t_vectorized:.2f}s, speedup x{t_groupby / t_vectorized:.0f}')
+
+
+class _SyntheticGabaixModel(GabaixModel):
+    # Gabaix model on the synthetic curves, with 10 new clusters per year
+    def fit(self):
+        mean_growth_rate, std_growth_rate = _synthetic_curves()
+        return (lambda year: 10 * (np.asarray(year) - 1850)), mean_growth_rate, std_growth_rate
+
+
+def benchmark_ensemble(n_runs: int = 200, n_steps: int = 90, n_clusters: int = 2000, seed: int = 0, significance: float = 0.001) -> None:
+    # The ensemble must leave the model untouched, be reproducible for a given seed, and give final populations distributed as those of separate runs
+    pop = np.random.default_rng(seed).lognormal(mean=8, sigma=1.5, size=n_clusters)
+    model = _SyntheticGabaixModel(pop=pop.copy())
+    ensemble = model.run_ensemble(n_runs=n_runs, n_steps=n_steps, seed=seed)
+    assert np.array_equal(model.pop, pop) and model._current_year == 1850, 'The ensemble changed the model'
+    assert all(traj.shape == (n_runs, n_clusters + 10 * step) for step, traj in ensemble.items()), 'Wrong ensemble layout'
+    assert np.array_equal(ensemble[n_steps], model.run_ensemble(n_runs=n_runs, n_steps=n_steps, seed=seed)[n_steps]), 'The ensemble is not reproducible'
+
+    def serial_runs():
+        runs = []
+        for i in range(n_runs):
+            model_ = _SyntheticGabaixModel(pop=pop.copy(), rng=np.random.default_rng(seed + 1 + i))
+            model_.run(n_steps)
+            runs.append(model_.pop)
+
+        return np.array(runs)
+
+    serial = serial_runs()
+    for name, statistic in {'total population': lambda x: x.sum(axis=1), 'largest cluster': lambda x: x.max(axis=1)}.items():
+        p_value = scipy.stats.ks_2samp(statistic(ensemble[n_steps]), statistic(serial)).pvalue
+        assert p_value > significance, f'ensemble {name} differs from that of separate runs (KS p-value {p_value:.2g})'
+
+    t_serial = _time(serial_runs, repeat=1)
+    t_ensemble = _time(lambda: model.run_ensemble(n_runs=n_runs, n_steps=n_steps, seed=seed), repeat=1)
+    print(f'ensemble, {n_runs} runs of {n_steps} steps, n={n_clusters}: separate runs {t_serial:.2f}s, ensemble {t_ensemble:.2f}s, speedup x{t_serial / t_ensemble:.1f}')
+
+
+def check_lumps_per_cluster(n_clusters: int = 10 ** 4, seed: int = 0) -> None:
+    # The initial lumps of the Duranton model must cover the population of each cluster with lumps drawn by the sampler only. With a scalar
+    # sampler they must also be the ones drawn by calling the sampler on each cluster in turn.
+    rng = np.random.default_rng(seed)
+    pop = rng.lognormal(mean=6, sigma=2, size=n_clusters)
+    pop[::50], pop[1::50], pop[2::50] = 0, -1, 1
+
+    drawn = []
+
+    def record(lumps):
+        drawn.append(lumps)
+        return lumps
+
+    samplers = {'vectorized': LumpSampler(lambda size: record(np.random.lognormal(mean=4, sigma=1, size=size))),
+                'scalar': ScalarLumpSampler(lambda: record(np.random.lognormal(mean=4, sigma=1)))}
+    for name, sampler in samplers.items():
+        # The model is only used for its sampler, so it is not fitted
+        model = DurantonModel.__new__(DurantonModel)
+        model.lump_sampler = sampler
+        np.random.seed(seed)
+        drawn.clear()
+        lumps, clusters = model._sample_lumps_per_cluster(pop)
+        drawn_lumps = np.hstack(drawn)
+
+        totals, counts = np.bincount(clusters, weights=lumps, minlength=n_clusters), np.bincount(clusters, minlength=n_clusters)
+        assert np.all(totals[pop > 0] >= pop[pop > 0]) and np.all(counts[pop <= 0] == 0), f'{name}: lumps do not cover the population of each cluster'
+        assert np.all(np.isin(lumps, drawn_lumps)), f'{name}: lumps not drawn by the sampler'
+
+        if name != 'scalar':
+            continue
+
+        np.random.seed(seed)
+        expected = [model._sample_lumps(p) for p in pop]
+        assert np.array_equal(lumps, np.concatenate(expected)) and np.array_equal(clusters, np.repeat(np.arange(n_clusters), [len(e) for e in expected])), \
+            f'{name}: lumps differ from those sampled cluster by cluster'
+
+
+if __name__ == '__main__':
+    benchmark_normal_growth_rate()
+    check_levy_stable_sampler()
+    benchmark_levy_stable_growth_rate()
+    benchmark_annualized_growth_rate()
+    benchmark_ensemble()
+    check_lumps_per_cluster()
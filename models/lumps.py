@@ -0,0 +1,148 @@
+from typing import Callable
+import numpy as np
+
+
+class LumpSampler:
+    """
+    Vectorized lump sampler: the wrapped function takes a number of lumps and returns an array with their populations,
+    e.g. LumpSampler(lambda size: np.random.lognormal(mean=4, sigma=1, size=size)).
+    """
+    def __init__(self, sampler: Callable[[int], np.ndarray], batch_size: int = 256):
+        self.sampler = sampler
+        self.batch_size = batch_size
+
+    def __call__(self, size: int) -> np.ndarray:
+        return np.asarray(self.sampler(size))
+
+    def sample(self, total_pop: float) -> np.ndarray:
+        """
+        Sample lumps until their population reaches total_pop. Lumps are drawn in batches sized from the mean lump
+        population seen so far, and the overshoot is cut after the first lump whose cumulative population reaches total_pop.
+        """
+        if total_pop <= 0:
+            return np.array([])
+
+        batches = []
+        n_lumps, sum_pop_lumps, size = 0, 0, self.batch_size
+        while sum_pop_lumps < total_pop:
+            batch = self(size)
+            batches.append(batch)
+            n_lumps += len(batch)
+            sum_pop_lumps += batch.sum()
+            mean_lump = sum_pop_lumps / n_lumps
+            size = self.batch_size if mean_lump <= 0 else int(1.1 * (total_pop - sum_pop_lumps) / mean_lump) + 16
+
+        lumps = np.concatenate(batches)
+        end = np.searchsorted(np.cumsum(lumps, dtype=np.float64), total_pop, side='left')
+        return lumps[:end + 1]
+
+
+class ScalarLumpSampler(LumpSampler):
+    """
+    Adapter for samplers returning one lump per call. Lumps are still drawn one at a time in sample, so that no lump is
+    drawn past total_pop and the random stream is the same as with the sampler called in a loop.
+    """
+    def __init__(self, sampler: Callable[[], int]):
+        super().__init__(sampler=sampler)
+
+    def __call__(self, size: int) -> np.ndarray:
+        return np.array([self.sampler() for _ in range(size)])
+
+    def sample(self, total_pop: float) -> np.ndarray:
+        lumps = []
+        sum_pop_lumps = 0
+        while sum_pop_lumps < total_pop:
+            lump_pop = self.sampler()
+            lumps.append(lump_pop)
+            sum_pop_lumps += lump_pop
+
+        return np.array(lumps)
+
+
+def as_lump_sampler(sampler) -> LumpSampler:
+    return sampler if isinstance(sampler, LumpSampler) else ScalarLumpSampler(sampler)
+
+
+class LumpRegister:
+    """
+    Lumps of population and the cluster each of them belongs to, stored in preallocated arrays.
+
+    Lumps are kept in insertion order, and the arrays grow geometrically when they are full. The number of lumps and the
+    total population of each cluster are updated incrementally whenever lumps are added or removed, so they never require
+    a pass over the whole register.
+    """
+    def __init__(self, lumps: np.ndarray, clusters: np.ndarray, n_clusters: int = 0):
+        self._lumps = np.empty(max(16, len(lumps)), dtype=np.float64)
+        self._clusters = np.empty(max(16, len(lumps)), dtype=np.int64)
+        self._n_lumps = 0
+        self._cluster_count = np.zeros(max(16, n_clusters), dtype=np.int64)
+        self._cluster_sum = np.zeros(max(16, n_clusters), dtype=np.float64)
+        self._n_clusters = n_clusters
+        self.add(lumps=lumps, clusters=clusters)
+
+    def __len__(self) -> int:
+        return self._n_lumps
+
+    @property
+    def n_clusters(self) -> int:
+        return self._n_clusters
+
+    @property
+    def lumps(self) -> np.ndarray:
+        return self._lumps[:self._n_lumps]
+
+    @property
+    def clusters(self) -> np.ndarray:
+        return self._clusters[:self._n_lumps]
+
+    @property
+    def cluster_count(self) -> np.ndarray:
+        return self._cluster_count[:self._n_clusters]
+
+    @property
+    def cluster_population(self) -> np.ndarray:
+        return self._cluster_sum[:self._n_clusters]
+
+    def add(self, lumps: np.ndarray, clusters: np.ndarray) -> None:
+        if len(lumps) == 0:
+            return
+
+        n_lumps = self._n_lumps + len(lumps)
+        if n_lumps > len(self._lumps):
+            capacity = max(n_lumps, 2 * len(self._lumps))
+            self._lumps = _resize(self._lumps, capacity)
+            self._clusters = _resize(self._clusters, capacity)
+
+        self._lumps[self._n_lumps:n_lumps] = lumps
+        self._clusters[self._n_lumps:n_lumps] = clusters
+        self._n_lumps = n_lumps
+
+        n_clusters = max(self._n_clusters, int(np.max(clusters)) + 1)
+        if n_clusters > len(self._cluster_count):
+            capacity = max(n_clusters, 2 * len(self._cluster_count))
+            self._cluster_count = _resize(self._cluster_count, capacity, fill=0)
+            self._cluster_sum = _resize(self._cluster_sum, capacity, fill=0)
+
+        self._n_clusters = n_clusters
+        np.add.at(self._cluster_count, clusters, 1)
+        np.add.at(self._cluster_sum, clusters, lumps)
+
+    def remove(self, index: np.ndarray) -> None:
+        if len(index) == 0:
+            return
+
+        np.subtract.at(self._cluster_count, self._clusters[index], 1)
+        np.subtract.at(self._cluster_sum, self._clusters[index], self._lumps[index])
+
+        keep = np.ones(self._n_lumps, dtype=bool)
+        keep[index] = False
+        n_lumps = int(keep.sum())
+        self._lumps[:n_lumps] = self._lumps[:self._n_lumps][keep]
+        self._clusters[:n_lumps] = self._clusters[:self._n_lumps][keep]
+        self._n_lumps = n_lumps
+
+
+def _resize(a: np.ndarray, capacity: int, fill=None) -> np.ndarray:
+    resized = np.empty(capacity, dtype=a.dtype) if fill is None else np.full(capacity, fill, dtype=a.dtype)
+    resized[:len(a)] = a
+    return resized
@@ -1,22 +1,36 @@
-from typing import Any, Callable, Tuple, Dict
+from typing import Any, Callable, Mapping, Sequence, Tuple, Dict, Union
 import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
 import clusterdb as cdb
+import hashlib
+import os
 from abc import ABC, abstractmethod
-import scipy
-import json
 
 from utils import remove_outliers, nadaraya_watson_estimator, plot_zipf_regression
+from sampling import sample_normal_growth_rate, sample_levy_stable_growth_rate, sample_categories
+from lumps import LumpRegister, LumpSampler, as_lump_sampler
+from trajectory import TrajectoryBuffer, save_trajectory
+from observers import Observer
 
 
 class Model(ABC):
-    def __init__(self, name: str, pop: np.ndarray, plot_fit: bool = False):
+    def __init__(self, name: str, pop: np.ndarray, plot_fit: bool = False, rng: np.random.Generator = None):
         self.name = name
         self.pop = pop
+        self._rng = rng
         self.traj = None
         self.fitter = CurveFitter(plot_fit=plot_fit)
 
+    @property
+    def rng(self):
+        # Random draws go through self.rng, so that independent runs can be given independent generators. Without one, the global numpy state is used.
+        return np.random if self._rng is None else self._rng
+
+    @rng.setter
+    def rng(self, rng: np.random.Generator):
+        self._rng = rng
+
     @abstractmethod
     def step(self) -> None:
         pass
@@ -24,198 +38,331 @@ class Model(ABC):
     def init(self) -> None:
         pass
 
-    def run(self, n_steps: int) -> Dict[int, np.ndarray]:
+    def run(self, n_steps: int, writer=None, store_traj: bool = True, observers: Sequence[Observer] = ()) -> Mapping[int, np.ndarray]:
+        # With a writer, each step is written out as soon as it is computed, and observers compute their statistics on each step.
+        # store_traj=False then avoids keeping the whole trajectory in memory.
         print(f'Running {self.name} model')
-        traj = {0: self.pop.copy()}
+        traj = TrajectoryBuffer(capacity=self._trajectory_capacity(n_steps)) if store_traj else None
+        self._notify(0, traj=traj, writer=writer, observers=observers)
+
         for i in range(n_steps):
             self.step()
-            traj.update({i + 1: self.pop.copy()})
+            self._notify(i + 1, traj=traj, writer=writer, observers=observers)
 
         self.traj = traj
         return traj
 
+    def _trajectory_capacity(self, n_steps: int) -> int:
+        # Total number of clusters over the steps of a run, if the number of clusters grows as the fitted curve get_num_clusters, or stays the same
+        # for a model without one
+        if not hasattr(self, 'get_num_clusters'):
+            return (n_steps + 1) * len(self.pop)
+
+        n_clusters = len(self.pop) + self.get_num_clusters(self._current_year + np.arange(n_steps + 1)) - self.get_num_clusters(self._current_year)
+        return int(np.sum(np.clip(n_clusters, len(self.pop), np.inf)))
+
+    def _notify(self, step: int, traj: TrajectoryBuffer, writer, observers: Sequence[Observer]) -> None:
+        if traj is not None:
+            traj.append(step, self.pop)
+        if writer is not None:
+            writer.write(step, self.pop)
+        for observer in observers:
+            observer.observe(step, self.pop)
+
+    def run_ensemble(self, n_runs: int, n_steps: int, seed: int = None) -> Dict[int, np.ndarray]:
+        raise NotImplementedError(f'{self.name} model does not support ensemble runs')
+
     @abstractmethod
     def fit(self) -> Any:
         pass
 
-    def plot(self, frequency: int, fig: go.Figure = None, color: str = 'black') -> go.Figure:
+    def plot(self, frequency: int, fig: go.Figure = None, color: str = 'black', max_points: int = 1000) -> go.Figure:
         fig = go.Figure() if fig is None else fig
         for key, val in self.traj.items():
             if key % frequency == 0:
                 pop = 1 + pd.Series(val).to_frame(name='population')
-                color_ = pd.DataFrame(np.array([color] * len(pop)).reshape(-1, 1), columns=['color'], index=pop.index)
-                fig = plot_zipf_regression(population=pop, fig=fig,color=color_, name=f'{self.name}--{key}', plot_theory=False, plot_annotation=False, plot_regression=False, threshold_regression=5 * 10 ** 3)
+                fig = plot_zipf_regression(population=pop, fig=fig, color=color, name=f'{self.name}--{key}', plot_theory=False, plot_annotation=False, plot_regression=False, threshold_regression=5 * 10 ** 3,
+                                           max_points=max_points)
 
         return fig
 
-    def compare(self, frequency: int, fig: go.Figure = None) -> go.Figure:
-        fig = self.plot(frequency=frequency, fig=fig)
-        data = cdb.get_cluster_population()
+    def compare(self, frequency: int, fig: go.Figure = None, max_points: int = 1000) -> go.Figure:
+        fig = self.plot(frequency=frequency, fig=fig, max_points=max_points)
+        data = self.fitter.get_table('get_cluster_population')
         years = data['year'].unique()
         for year in years:
             if (year - 1850) % frequency == 0:
                 pop = 1 + data[data['year'] == year]['population'].values
                 pop = pd.Series(pop).to_frame(name='population')
-                color = pd.DataFrame(np.array(['red'] * len(pop)).reshape(-1, 1), columns=['color'], index=pop.index)
-                fig = plot_zipf_regression(population=pop, fig=fig, color=color, name=f'real--{year}', plot_theory=False, plot_annotation=False, plot_regression=False, threshold_regression=5 * 10 ** 3)
+                fig = plot_zipf_regression(population=pop, fig=fig, color='red', name=f'real--{year}', plot_theory=False, plot_annotation=False, plot_regression=False, threshold_regression=5 * 10 ** 3,
+                                           max_points=max_points)
 
         return fig
 
     def save_traj(self, file_path: str) -> None:
-        with open(file_path, "w") as outfile:
-            json.dump({k: v.tolist() for k, v in self.traj.items()}, outfile)
+        save_trajectory(self.traj, file_path)
+
+
+class Interpolant:
+    # Piecewise linear interpolation of a fitted curve, evaluated on scalars or arrays. Unlike a closure it can be pickled, e.g. to send models to worker processes.
+    def __init__(self, x: np.ndarray, y: np.ndarray):
+        self.x = x
+        self.y = y
+
+    def __call__(self, x):
+        return np.interp(x, self.x, self.y)
 
 
 class CurveFitter:
-    def __init__(self, plot_fit: bool = False):
+    # Fitted curves are cached by (dataset, curve, parameters) for the lifetime of the process, and as npz arrays in cache_dir, which defaults to
+    # default_cache_dir, so that they are fitted once across processes too. The clusterdb tables are cached in memory in the same way, so
+    # instantiating several models queries the database and fits each curve only once. The files do not track the content of the database, so
+    # the directory must be deleted when it is rebuilt. Setting CurveFitter.default_cache_dir = None turns the disk cache off.
+    _curves: Dict[Tuple, Interpolant] = {}
+    _tables: Dict[Tuple, pd.DataFrame] = {}
+    default_cache_dir: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.curve_cache')
+    # Part of the name of the npz files, to be bumped whenever a fit changes (e.g. its outlier removal) so that the curves fitted before are not read
+    fit_version: int = 2
+
+    def __init__(self, plot_fit: bool = False, cache_dir: str = None, dataset: str = 'clusterdb'):
         self.plot_fit = plot_fit
+        self.cache_dir = CurveFitter.default_cache_dir if cache_dir is None else cache_dir
+        self.dataset = dataset
+
+    @classmethod
+    def clear_cache(cls) -> None:
+        cls._curves.clear()
+        cls._tables.clear()
+
+    def get_table(self, query: str, **kwargs) -> pd.DataFrame:
+        key = (self.dataset, query) + tuple(sorted(kwargs.items()))
+        if key not in CurveFitter._tables:
+            CurveFitter._tables[key] = getattr(cdb, query)(**kwargs)
+
+        return CurveFitter._tables[key]
+
+    def _get_curve(self, key: Tuple, fit: Callable[[], Interpolant]) -> Interpolant:
+        key = (self.dataset,) + key
+        if key in CurveFitter._curves:
+            return CurveFitter._curves[key]
+
+        file_path = None if self.cache_dir is None else os.path.join(self.cache_dir, f'{hashlib.sha1(repr((CurveFitter.fit_version,) + key).encode()).hexdigest()}.npz')
+        if file_path is not None and os.path.exists(file_path):
+            arrays = np.load(file_path)
+            curve = Interpolant(x=arrays['x'], y=arrays['y'])
+        else:
+            curve = fit()
+            if file_path is not None:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                np.savez(file_path, x=curve.x, y=curve.y)
+
+        CurveFitter._curves[key] = curve
+        return curve
+
+    def _plot_curve(self, curve: Interpolant, name: str, title: str, yaxis_title: str) -> None:
+        fig = go.Figure()
+        x_ = np.logspace(start=2, stop=7, num=100, base=10)
+        y_ = curve(x_)
+        fig.add_trace(go.Scatter(x=np.log10(x_), y=y_, mode='lines', name=name))
+        fig.update_layout(title=title, xaxis_title='Population', yaxis_title=yaxis_title, template='plotly_white')
+        fig.show()
+
+    def mean_growth_rate_curve(self, years: Tuple[int, int] = None, q: float = 0.00001, nbins: int = 100, h: float = 1):
+        years = None if years is None else tuple(years)
+        mean_growth_rate = self._get_curve(key=('mean_growth_rate', years, q, nbins, h), fit=lambda: self._fit_mean_growth_rate(years=years, q=q, nbins=nbins, h=h))
+        if self.plot_fit:
+            self._plot_curve(mean_growth_rate, name='mean growth rate', title='Mean growth rate', yaxis_title='Growth rate')
 
-    def mean_growth_rate_curve(self, years: Tuple[int, int] = None):
+        return mean_growth_rate
+
+    def _fit_mean_growth_rate(self, years: Tuple[int, int], q: float, nbins: int, h: float) -> Interpolant:
         growth_measure = 'annualized_growth_rate'
-        q = 0.00001
-        growth = cdb.get_cluster_growth_rate(years=years)
-        remove_outliers(data=growth, col_name=growth_measure, q=q)
-        nd_estimator_growth = nadaraya_watson_estimator(data=growth, x_name='population', y_name=growth_measure, nbins=100)
+        growth = self.get_table('get_cluster_growth_rate', years=years)
+        growth = remove_outliers(data=growth, col_name=growth_measure, q=q)
+        nd_estimator_growth = nadaraya_watson_estimator(data=growth, x_name='population', y_name=growth_measure, nbins=nbins, h=h)
         x, y = nd_estimator_growth.index.values, nd_estimator_growth[f'mean_{growth_measure}'].values
+        return Interpolant(x=x, y=y)
 
-        def mean_growth_rate(size: float):
-            return np.interp(size, x, y)
-
+    def std_growth_rate_curve(self, nbins: int = 100, h: float = 0.5):
+        std_growth_rate = self._get_curve(key=('std_growth_rate', nbins, h), fit=lambda: self._fit_std_growth_rate(nbins=nbins, h=h))
         if self.plot_fit:
-            fig = go.Figure()
-            x_ = np.logspace(start=2, stop=7, num=100, base=10)
-            y_ = np.array([mean_growth_rate(size) for size in x_])
-            fig.add_trace(go.Scatter(x=np.log10(x_), y=y_, mode='lines', name='mean growth rate'))
-            fig.update_layout(title='Mean growth rate', xaxis_title='Population', yaxis_title='Growth rate', template='plotly_white')
-            fig.show()
+            self._plot_curve(std_growth_rate, name='mean growth rate', title='Std growth rate', yaxis_title='Std growth rate')
 
-        return mean_growth_rate
+        return std_growth_rate
 
-    def std_growth_rate_curve(self):
-        growth_rate = cdb.get_cluster_growth_rate()
+    def _fit_std_growth_rate(self, nbins: int, h: float) -> Interpolant:
+        growth_rate = self.get_table('get_cluster_growth_rate', years=None)
         growth_measure = 'annualized_growth_rate'
         growth_rate = growth_rate.sort_values(by=['cluster_uid', 'year'])
         growth_rate_grouped = growth_rate.groupby('cluster_uid').agg({growth_measure: 'std', 'population': 'first'}).reset_index().dropna()
-        nd = nadaraya_watson_estimator(data=growth_rate_grouped, x_name='population', y_name=growth_measure, nbins=100, h=0.5)
+        nd = nadaraya_watson_estimator(data=growth_rate_grouped, x_name='population', y_name=growth_measure, nbins=nbins, h=h)
         x, y = nd.index.values, nd[f'mean_{growth_measure}'].values
-
-        def std_growth_rate(size: float):
-            return np.interp(size, x, y)
-
-        if self.plot_fit:
-            fig = go.Figure()
-            x_ = np.logspace(start=2, stop=7, num=100, base=10)
-            y_ = np.array([std_growth_rate(size) for size in x_])
-            fig.add_trace(go.Scatter(x=np.log10(x_), y=y_, mode='lines', name='mean growth rate'))
-            fig.update_layout(title='Std growth rate', xaxis_title='Population', yaxis_title='Std growth rate', template='plotly_white')
-            fig.show()
-
-        return std_growth_rate
+        return Interpolant(x=x, y=y)
 
     def num_cluster_curve(self):
-        pop = cdb.get_cluster_population()
-        number_of_clusters = pop.groupby('year').count()['cluster_uid']
+        def fit():
+            pop = self.get_table('get_cluster_population')
+            number_of_clusters = pop.groupby('year').count()['cluster_uid']
+            return Interpolant(x=number_of_clusters.index.values, y=number_of_clusters.values)
 
-        def num_clusters(year: int):
-            return np.interp(year, number_of_clusters.index, number_of_clusters.values)
-
-        return num_clusters
+        return self._get_curve(key=('num_clusters',), fit=fit)
 
     def population_curve(self):
-        pop = cdb.get_cluster_population()
-        total_population = pop.groupby('year')['population'].sum()
-
-        def population(year: int):
-            return np.interp(year, total_population.index, total_population.values)
+        def fit():
+            pop = self.get_table('get_cluster_population')
+            total_population = pop.groupby('year')['population'].sum()
+            return Interpolant(x=total_population.index.values, y=total_population.values)
 
-        return population
+        return self._get_curve(key=('population',), fit=fit)
 
 
 class RandomWalkModel(Model):
-    def __init__(self, name: str, pop: np.ndarray, lower_bound: int, plot_fit: bool = False):
-        super().__init__(name=name, pop=pop, plot_fit=plot_fit)
+    def __init__(self, name: str, pop: np.ndarray, lower_bound: int, plot_fit: bool = False, rng: np.random.Generator = None):
+        super().__init__(name=name, pop=pop, plot_fit=plot_fit, rng=rng)
         self.get_num_clusters, self.get_mean_growth_rate, self.get_std_growth_rate = self.fit()
         self.lower_bound = lower_bound
         self._current_year = 1850
+        self._buffer = None
 
     @abstractmethod
-    def _get_growth_rate(self):
+    def _sample_growth_rate(self, pop: np.ndarray, rng) -> np.ndarray:
         pass
 
+    def _get_growth_rate(self):
+        return self._sample_growth_rate(pop=self.pop, rng=self.rng)
+
+    def _get_num_new_clusters(self, year: int) -> int:
+        return int(self.get_num_clusters(year+1) - self.get_num_clusters(year))
+
     def step(self):
         growth_rate = self._get_growth_rate()
-        self.pop *= growth_rate
-        new_clusters = np.random.lognormal(mean=8, sigma=1, size=int(self.get_num_clusters(year=self._current_year+1) - self.get_num_clusters(year=self._current_year)))
-        self.pop = np.append(self.pop, new_clusters)
-        self.pop = np.clip(self.pop, self.lower_bound, np.inf)
+        n_clusters, n_new_clusters = len(self.pop), self._get_num_new_clusters(year=self._current_year)
+        pop = self._reserve(n_clusters + n_new_clusters)
+        pop[:n_clusters] *= growth_rate
+        pop[n_clusters:] = self.rng.lognormal(mean=8, sigma=1, size=n_new_clusters)
+        np.clip(pop, self.lower_bound, np.inf, out=pop)
+        self.pop = pop
         self._current_year += 1
 
+    def _reserve(self, size: int) -> np.ndarray:
+        # self.pop is a view on the start of a buffer which grows geometrically, so that the clusters of a step are added in place.
+        # The buffer is reallocated, and the populations copied into it, only when it is full or when self.pop has been replaced.
+        buffer = self._buffer
+        if buffer is None or self.pop.base is not buffer or size > len(buffer):
+            buffer = np.empty(max(size, 2 * len(self.pop)), dtype=np.float64)
+            buffer[:len(self.pop)] = self.pop
+            self._buffer = buffer
+
+        return buffer[:size]
+
+    def run_ensemble(self, n_runs: int, n_steps: int, seed: int = None) -> Dict[int, np.ndarray]:
+        # Runs n_runs independent realizations at once, the trajectory holding an (n_runs, n_clusters) array per step. Each step evaluates the fitted
+        # curves on all the runs and draws their shocks in a single call to one generator, so the runs are independent but, unlike those of multirun,
+        # cannot be reproduced one by one. The number of new clusters per year does not depend on the run, so all the runs share a layout padded to
+        # the final number of clusters, in which only the first n_clusters[i] clusters are active at step i. The state is stored cluster-major, so
+        # that the active clusters are contiguous and the populations of a cluster across runs, which are close, are interpolated one after another.
+        # The model itself is left untouched.
+        print(f'Running {n_runs} runs of {self.name} model')
+        rng = np.random.default_rng(seed)
+        n_new_clusters = [self._get_num_new_clusters(year=self._current_year + i) for i in range(n_steps)]
+        n_clusters = len(self.pop) + np.cumsum([0] + n_new_clusters)
+
+        pop = np.empty((n_clusters[-1], n_runs))
+        pop[:n_clusters[0]] = self.pop[:, np.newaxis]
+        traj = {0: pop[:n_clusters[0]].T.copy()}
+        for i in range(n_steps):
+            active, new = pop[:n_clusters[i]], pop[n_clusters[i]:n_clusters[i + 1]]
+            active *= self._sample_growth_rate(pop=active, rng=rng)
+            new[...] = rng.lognormal(mean=8, sigma=1, size=new.shape)
+            np.clip(pop[:n_clusters[i + 1]], self.lower_bound, np.inf, out=pop[:n_clusters[i + 1]])
+            traj.update({i + 1: pop[:n_clusters[i + 1]].T.copy()})
+
+        return traj
+
     def fit(self):
         return self.fitter.num_cluster_curve(), self.fitter.mean_growth_rate_curve(), self.fitter.std_growth_rate_curve()
 
 
 class GabaixModel(RandomWalkModel):
-    def __init__(self, pop: np.ndarray, lower_bound: int = 10 ** 2, plot_fit: bool = False):
-        super().__init__(name='gabaix', pop=pop, lower_bound=lower_bound, plot_fit=plot_fit)
+    def __init__(self, pop: np.ndarray, lower_bound: int = 10 ** 2, plot_fit: bool = False, rng: np.random.Generator = None):
+        super().__init__(name='gabaix', pop=pop, lower_bound=lower_bound, plot_fit=plot_fit, rng=rng)
 
-    def _get_growth_rate(self):
-        growth_rate = 1 + np.array([np.random.normal(loc=self.get_mean_growth_rate(p), scale=self.get_std_growth_rate(p)) for p in self.pop])
-        growth_rate = np.clip(growth_rate, 0, np.inf)
-        return growth_rate
+    def _sample_growth_rate(self, pop: np.ndarray, rng) -> np.ndarray:
+        return sample_normal_growth_rate(pop=pop, mean_growth_rate=self.get_mean_growth_rate, std_growth_rate=self.get_std_growth_rate, rng=rng)
 
 
 class BarthelemyModel(RandomWalkModel):
-    def __init__(self, pop: np.ndarray, lower_bound: int = 10**2, plot_fit: bool = False):
-        super().__init__(name='barthelemy', pop=pop, plot_fit=plot_fit, lower_bound=lower_bound)
+    def __init__(self, pop: np.ndarray, lower_bound: int = 10**2, plot_fit: bool = False, rng: np.random.Generator = None):
+        super().__init__(name='barthelemy', pop=pop, plot_fit=plot_fit, lower_bound=lower_bound, rng=rng)
         self.get_shock_exponent = self._fit_shock_exponent()
 
-    def _get_growth_rate(self):
-        growth_rates = 1 + np.array([scipy.stats.levy_stable.rvs(alpha=self.get_shock_exponent(p), beta=0, loc=self.get_mean_growth_rate(p), scale=self.get_std_growth_rate(p)) for p in self.pop])
-        growth_rates = np.clip(growth_rates, 0, np.inf)
-        return growth_rates
+    def _sample_growth_rate(self, pop: np.ndarray, rng) -> np.ndarray:
+        return sample_levy_stable_growth_rate(pop=pop, mean_growth_rate=self.get_mean_growth_rate, std_growth_rate=self.get_std_growth_rate, shock_exponent=self.get_shock_exponent, rng=rng)
 
     def _fit_shock_exponent(self):
-        def shock_exponent(size: float):
-            if size < 5 * 10 ** 3:
-                return 1.25
-            else:
-                return 1.5
-
-        return shock_exponent
+        return _shock_exponent
 
 
 class PreferentialAttachmentModel(Model):
-    def __init__(self, name: str, pop: np.ndarray, lump_sampler: Callable[[], int], plot_fit: bool = False):
-        super().__init__(name=name, pop=pop, plot_fit=plot_fit)
-        self.lump_sampler = lump_sampler
+    def __init__(self, name: str, pop: np.ndarray, lump_sampler: Union[LumpSampler, Callable[[], int]], plot_fit: bool = False, rng: np.random.Generator = None):
+        super().__init__(name=name, pop=pop, plot_fit=plot_fit, rng=rng)
+        self.lump_sampler = as_lump_sampler(lump_sampler)
         self.get_population, self.get_num_clusters, self.get_mean_growth_rate, self.get_std_growth_rate = self.fit()
         self._current_year = 1850
 
     def _sample_lumps(self, total_pop: float) -> np.ndarray:
+        return self.lump_sampler.sample(total_pop)
+
+    def _sample_lumps_per_cluster(self, pop: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # The sampler is called on the population of all the remaining clusters, and the lumps are split in consecutive runs, each ending with the
+        # first lump that covers the population of its cluster. A scalar sampler thus draws the same lumps as calling _sample_lumps on each cluster
+        # in turn, while a vectorized one goes on with the rest of its last batch instead of discarding it.
+        remaining_pop = np.cumsum(np.clip(pop[::-1], 0, np.inf))[::-1]
+        n_lumps = np.zeros(len(pop), dtype=np.int64)
         lumps = []
-        sum_pop_lumps = 0
-        while sum_pop_lumps < total_pop:
-            lump_pop = self.lump_sampler()
-            lumps.append(lump_pop)
-            sum_pop_lumps += lump_pop
-
-        return np.array(lumps)
-
-    def _assign_lump_to_cluster(self, lumps: np.ndarray) -> pd.DataFrame:
+        i, pop_filled = 0, 0
+        while i < len(pop):
+            sampled_lumps = self._sample_lumps(remaining_pop[i] - pop_filled)
+            cum_sampled_lumps = np.cumsum(sampled_lumps, dtype=np.float64)
+            lumps.append(sampled_lumps)
+            start, offset = 0, 0
+            while i < len(pop):
+                if pop[i] - pop_filled <= 0:
+                    i, pop_filled = i + 1, 0
+                    continue
+
+                if start == len(sampled_lumps):
+                    break
+
+                end = np.searchsorted(cum_sampled_lumps, offset + pop[i] - pop_filled, side='left')
+                if end == len(sampled_lumps):
+                    n_lumps[i] += end - start
+                    pop_filled += cum_sampled_lumps[-1] - offset
+                    start = end
+                    break
+
+                n_lumps[i] += end + 1 - start
+                start, offset = end + 1, cum_sampled_lumps[end]
+                i, pop_filled = i + 1, 0
+
+        lumps = np.concatenate(lumps) if len(lumps) > 0 else np.array([])
+        return lumps, np.repeat(np.arange(len(pop)), n_lumps)
+
+    def _assign_lump_to_cluster(self, lumps: np.ndarray) -> np.ndarray:
+        # Returns the cluster index of each lump, where len(self.pop) stands for a new cluster
         if len(lumps) == 0:
-            return pd.DataFrame(columns=['lump', 'cluster'])
+            return np.array([], dtype=np.int64)
 
-        growth_rate = np.array([self.get_mean_growth_rate(p) for p in self.pop])
+        growth_rate = self.get_mean_growth_rate(self.pop)
         lump_assignment_proportional = self.pop * growth_rate
         lump_assignment_proportional = np.clip(lump_assignment_proportional, 0, np.inf)
         lump_assignment_probability = lump_assignment_proportional / lump_assignment_proportional.sum()
 
-        probability_new_cluster = min(1, (self.get_num_clusters(year=self._current_year+1) - self.get_num_clusters(year=self._current_year)) / len(lumps))
+        probability_new_cluster = min(1, (self.get_num_clusters(self._current_year+1) - self.get_num_clusters(self._current_year)) / len(lumps))
         lump_assignment_probability = (1 - probability_new_cluster) * lump_assignment_probability
         lump_assignment_probability = np.append(lump_assignment_probability, probability_new_cluster)
 
-        lump_assignment = np.random.choice(np.arange(len(self.pop) + 1), size=len(lumps), p=lump_assignment_probability)
-        lump_assignment = pd.DataFrame({'lump': lumps, 'cluster': lump_assignment})
+        lump_assignment = sample_categories(probability=lump_assignment_probability, size=len(lumps), rng=self.rng)
         return lump_assignment
 
     @abstractmethod
@@ -227,69 +374,64 @@ class PreferentialAttachmentModel(Model):
 
 
 class SimonModel(PreferentialAttachmentModel):
-    def __init__(self, pop: np.ndarray, lump_sampler: Callable[[], int], name: str = 'simon', plot_fit: bool = False):
-        super().__init__(name=name, pop=pop, lump_sampler=lump_sampler, plot_fit=plot_fit)
+    def __init__(self, pop: np.ndarray, lump_sampler: Union[LumpSampler, Callable[[], int]], name: str = 'simon', plot_fit: bool = False, rng: np.random.Generator = None):
+        super().__init__(name=name, pop=pop, lump_sampler=lump_sampler, plot_fit=plot_fit, rng=rng)
 
     def step(self):
-        pop_change = self.get_population(year=self._current_year + 1) - self.get_population(year=self._current_year)
+        pop_change = self.get_population(self._current_year + 1) - self.get_population(self._current_year)
         lumps = self._sample_lumps(pop_change)
 
         lump_assignment = self._assign_lump_to_cluster(lumps)
+        new_cluster_lumps = lump_assignment == len(self.pop)
 
-        lump_assignment_existing_clusters = lump_assignment[lump_assignment['cluster'] < len(self.pop)]
-        additional_pop_existing_clusters = lump_assignment_existing_clusters.groupby('cluster')['lump'].sum().sort_index()
-        new_pop_existing_clusters = self.pop.copy()
-        new_pop_existing_clusters[additional_pop_existing_clusters.index] += additional_pop_existing_clusters.values
-        pop_new_clusters = lump_assignment[lump_assignment['cluster'] == len(self.pop)]['lump'].values
+        additional_pop_existing_clusters = np.bincount(lump_assignment[~new_cluster_lumps], weights=lumps[~new_cluster_lumps], minlength=len(self.pop))
+        pop_new_clusters = lumps[new_cluster_lumps]
 
-        self.pop = np.append(new_pop_existing_clusters, pop_new_clusters)
+        self.pop = np.append(self.pop + additional_pop_existing_clusters, pop_new_clusters)
         self._current_year += 1
 
 
 class DurantonModel(PreferentialAttachmentModel):
-    def __init__(self, pop: np.ndarray, lump_sampler: Callable[[], int], plot_fit: bool = False, name: str = 'duranton', relocation_p: float = 0.001):
-        super().__init__(pop=pop, lump_sampler=lump_sampler, name=name, plot_fit=plot_fit)
-
-        self._lump_register = []
-        for i, p in enumerate(self.pop):
-            lumps = self._sample_lumps(p)
-            for l in lumps:
-                self._lump_register.append((l, i))
+    def __init__(self, pop: np.ndarray, lump_sampler: Union[LumpSampler, Callable[[], int]], plot_fit: bool = False, name: str = 'duranton', relocation_p: float = 0.001,
+                 rng: np.random.Generator = None):
+        super().__init__(pop=pop, lump_sampler=lump_sampler, name=name, plot_fit=plot_fit, rng=rng)
 
-        self._lump_register = pd.DataFrame(self._lump_register, columns=['lump', 'cluster'])
+        lumps, clusters = self._sample_lumps_per_cluster(self.pop)
+        self._lump_register = LumpRegister(lumps=lumps, clusters=clusters, n_clusters=len(self.pop))
         self.relocation_prob = relocation_p
 
     def _get_growth_rate(self):
-        growth_rate = 1 + np.array([np.random.normal(loc=self.get_mean_growth_rate(p), scale=self.get_std_growth_rate(p)) for p in self.pop])
-        growth_rate = np.clip(growth_rate, 0, np.inf)
-        return growth_rate
+        return sample_normal_growth_rate(pop=self.pop, mean_growth_rate=self.get_mean_growth_rate, std_growth_rate=self.get_std_growth_rate, rng=self.rng)
 
     def step(self):
-        pop_change = self.get_population(year=self._current_year + 1) - self.get_population(year=self._current_year)
+        pop_change = self.get_population(self._current_year + 1) - self.get_population(self._current_year)
         new_lumps = self._sample_lumps(pop_change)
 
-        lump_count_cluster = self._lump_register.groupby('cluster')['lump'].count()
-        cluster_with_more_than_one_lump = lump_count_cluster[lump_count_cluster > 1].index
-        relocation_candidates = self._lump_register[self._lump_register['cluster'].isin(cluster_with_more_than_one_lump)]
+        relocation_candidates = np.flatnonzero(self._lump_register.cluster_count[self._lump_register.clusters] > 1)
+        n_relocating_lumps = self.rng.binomial(n=len(relocation_candidates), p=self.relocation_prob)
+        relocating_lumps_index = np.array([], dtype=np.int64)
+        if n_relocating_lumps > 0:
+            relocation_proportional = 1 / self._lump_register.lumps[relocation_candidates]
+            relocation_probs = relocation_proportional / relocation_proportional.sum()
+            relocating_lumps_index = self.rng.choice(relocation_candidates, size=n_relocating_lumps, replace=False, p=relocation_probs)
 
-        n_relocating_lumps = np.random.binomial(n=len(relocation_candidates), p=self.relocation_prob)
-        relocation_proportional = (1 / relocation_candidates['lump'].values)
-        relocation_probs = relocation_proportional / relocation_proportional.sum()
-        relocating_lumps_index = np.random.choice(relocation_candidates.index, size=n_relocating_lumps, replace=False, p=relocation_probs)
-        relocating_lumps = relocation_candidates.loc[relocating_lumps_index, 'lump'].values
-        self._lump_register = self._lump_register.drop(index=relocating_lumps_index)
+        relocating_lumps = self._lump_register.lumps[relocating_lumps_index]
+        self._lump_register.remove(relocating_lumps_index)
 
         lumps = np.append(new_lumps, relocating_lumps)
         lump_assignment = self._assign_lump_to_cluster(lumps)
 
-        lump_assignment_existing_clusters = lump_assignment[lump_assignment['cluster'] < len(self.pop)]
-        self._lump_register = pd.concat([self._lump_register, lump_assignment_existing_clusters], ignore_index=True)
+        new_cluster_lumps = lump_assignment == len(self.pop)
+        self._lump_register.add(lumps=lumps[~new_cluster_lumps], clusters=lump_assignment[~new_cluster_lumps])
 
-        lump_assignment_new_clusters = lump_assignment[lump_assignment['cluster'] == len(self.pop)].copy()
-        new_cluster_ids = np.arange(len(self.pop), len(self.pop) + len(lump_assignment_new_clusters))
-        lump_assignment_new_clusters['cluster'] = new_cluster_ids
-        self._lump_register = pd.concat([self._lump_register, lump_assignment_new_clusters], ignore_index=True)
+        new_cluster_ids = np.arange(len(self.pop), len(self.pop) + new_cluster_lumps.sum())
+        self._lump_register.add(lumps=lumps[new_cluster_lumps], clusters=new_cluster_ids)
 
-        self.pop = self._lump_register.groupby('cluster')['lump'].sum().sort_index().values
-        self.pop = np.clip(self.pop, 10**2, np.inf)
+        # Clusters whose lumps have all relocated keep their position, so cluster ids always index self.pop
+        self.pop = np.clip(self._lump_register.cluster_population, 10**2, np.inf)
         self._current_year += 1
+
+
+def _shock_exponent(size: np.ndarray) -> np.ndarray:
+    return np.where(np.asarray(size) < 5 * 10 ** 3, 1.25, 1.5)
+
@@ -1,42 +1,176 @@
+import contextlib
 import copy
-from typing import Dict
+import functools
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Sequence, Tuple
 import h5py
 import numpy as np
 import pandas as pd
 
 from models import Model
+from observers import Observer
 
 
-def save_multirun(model: Model, n_runs: int, n_steps: int) -> None:
-    with h5py.File("simulations.hdf5", "w") as f:
+def save_multirun(model: Model, n_runs: int, n_steps: int, file_path: str = 'simulations.hdf5', mode: str = 'a', n_workers: int = 1, seed: int = None,
+                  compression: str = 'gzip') -> None:
+    """
+    Run n_runs realizations of the model and store them in the group model.name of the HDF5 file, which replaces any
+    previous group of that name but keeps the other models of the file in the default append mode. With a single worker
+    each step is written as soon as it is computed, so that memory is bounded by one step. With n_workers > 1 the whole
+    trajectory of a run is sent back by its worker before being written.
+
+    HDF5 does not give back the space of a deleted group. New files are therefore created with a persistent free-space
+    manager, so that the space of a replaced model is reused by the next saves instead of growing the file at each of
+    them. Files created otherwise, e.g. by earlier versions, keep growing and must be compacted with h5repack.
+    """
+    create = mode in ('w', 'w-', 'x') or (mode == 'a' and not os.path.exists(file_path))
+    file_space = {'fs_strategy': 'fsm', 'fs_persist': True} if create else {}
+    with h5py.File(file_path, 'w' if create and mode == 'a' else mode, **file_space) as f:
+        if model.name in f:
+            del f[model.name]
         group = f.create_group(model.name)
-        for i in range(n_runs):
-            model_ = copy.deepcopy(model)
-            traj = model_.run(n_steps)
-            traj_df = _trajectory_dict_to_df(traj)
-            group.create_dataset(f'run_{i}', data=traj_df.values, dtype='int64')
+        seed_sequences = np.random.SeedSequence(seed).spawn(n_runs)
+        if n_workers == 1:
+            for i, seed_sequence in enumerate(seed_sequences):
+                writer = TrajectoryWriter(group.create_group(f'run_{i}'), compression=compression)
+                _run(model, n_steps, seed_sequence, writer=writer)
+        else:
+            for i, traj in enumerate(run_multirun(model=model, n_runs=n_runs, n_steps=n_steps, n_workers=n_workers, seed=seed)):
+                writer = TrajectoryWriter(group.create_group(f'run_{i}'), compression=compression)
+                for step, pop in traj.items():
+                    writer.write(step, pop)
+
+
+class TrajectoryWriter:
+    """
+    Writes a trajectory step by step to an HDF5 group, in a ragged layout: the populations of all the years are appended
+    to a single chunked and compressed dataset, and those of years[i] are population[offsets[i]:offsets[i + 1]], the
+    cluster_uid being the position within the year.
+    """
+    def __init__(self, group: h5py.Group, start_year: int = 1850, chunk_size: int = 2 ** 16, compression: str = 'gzip'):
+        self.start_year = start_year
+        self.population = group.create_dataset('population', shape=(0,), maxshape=(None,), dtype='int64', chunks=(chunk_size,),
+                                               compression=compression, shuffle=compression is not None)
+        self.years = group.create_dataset('years', shape=(0,), maxshape=(None,), dtype='int64', chunks=(1024,))
+        self.offsets = group.create_dataset('offsets', data=[0], maxshape=(None,), dtype='int64', chunks=(1024,))
+
+    def write(self, step: int, pop: np.ndarray) -> None:
+        start = self.offsets[-1]
+        end = start + len(pop)
+        self.population.resize((end,))
+        self.population[start:end] = pop
+        _append(self.years, self.start_year + step)
+        _append(self.offsets, end)
+
+
+def _append(dataset: h5py.Dataset, value) -> None:
+    n = len(dataset)
+    dataset.resize((n + 1,))
+    dataset[n] = value
+
+
+def run_multirun(model: Model, n_runs: int, n_steps: int, n_workers: int = 1, seed: int = None) -> Iterator[Dict[int, np.ndarray]]:
+    """
+    Run n_runs independent realizations of the model, on a pool of n_workers processes if n_workers > 1, and yield their
+    trajectories in run order.
+
+    Run i draws from a generator seeded with the i-th child of SeedSequence(seed), so its trajectory depends only on seed
+    and i, and not on the number of workers. With n_workers > 1 the model is pickled to the workers, so a custom lump
+    sampler must be defined at module level.
+    """
+    seed_sequences = np.random.SeedSequence(seed).spawn(n_runs)
+    run = functools.partial(_run, model, n_steps)
+    if n_workers == 1:
+        yield from map(run, seed_sequences)
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            yield from executor.map(run, seed_sequences)
+
+
+def observe_multirun(model: Model, n_runs: int, n_steps: int, observers: Sequence[Observer], n_workers: int = 1, seed: int = None) -> Iterator[List[Observer]]:
+    """
+    Run n_runs realizations of the model as run_multirun does, but yield for each run a copy of observers that observed it
+    instead of its trajectory, which is never stored.
+    """
+    seed_sequences = np.random.SeedSequence(seed).spawn(n_runs)
+    observe = functools.partial(_observe, model, n_steps, observers)
+    if n_workers == 1:
+        yield from map(observe, seed_sequences)
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            yield from executor.map(observe, seed_sequences)
+
 
+@contextlib.contextmanager
+def _seeded_copy(model: Model, seed_sequence: np.random.SeedSequence) -> Iterator[Model]:
+    model_ = copy.deepcopy(model)
+    model_.rng = np.random.default_rng(seed_sequence)
+    # Lump samplers usually draw from the global numpy state, which is reseeded per run for the same reason. The caller's state is restored
+    # after the run, since with a single worker the runs happen in the caller's process.
+    state = np.random.get_state()
+    np.random.seed(seed_sequence.generate_state(1))
+    try:
+        yield model_
+    finally:
+        np.random.set_state(state)
 
-def _trajectory_dict_to_df(traj: Dict[int, np.ndarray]) -> pd.DataFrame:
-    traj_data = []
-    for y, p in traj.items():
-        pop = p
-        ids = np.arange(len(pop))
-        traj_data.append(pd.DataFrame({'year': 1850 + y * np.ones(len(pop), dtype=np.int64), 'cluster_uid': ids, 'population': pop}))
 
-    traj_data = pd.concat(traj_data, ignore_index=True)
-    return traj_data
+def _run(model: Model, n_steps: int, seed_sequence: np.random.SeedSequence, writer: TrajectoryWriter = None) -> Dict[int, np.ndarray]:
+    with _seeded_copy(model, seed_sequence) as model_:
+        return model_.run(n_steps, writer=writer, store_traj=writer is None)
 
 
-def load_multirun(model_name: str, frequency) -> pd.DataFrame:
-    with h5py.File("simulations.hdf5", "r") as f:
+def _observe(model: Model, n_steps: int, observers: Sequence[Observer], seed_sequence: np.random.SeedSequence) -> List[Observer]:
+    observers = copy.deepcopy(observers)
+    with _seeded_copy(model, seed_sequence) as model_:
+        model_.run(n_steps, store_traj=False, observers=observers)
+
+    return observers
+
+
+def iter_multirun(model_name: str, frequency: int = 1, file_path: str = 'simulations.hdf5', runs: Iterable[int] = None, years: Iterable[int] = None,
+                  min_population: float = None) -> Iterator[Tuple[int, np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    Yield the (run, year, cluster_uid, population) arrays of the selected runs, with one row per cluster and year. Only
+    the years selected by frequency and years are read from the file, one slice per year, and the clusters smaller than
+    min_population are dropped as soon as their year is read.
+    """
+    with h5py.File(file_path, "r") as f:
         group = f[model_name]
-        traj = []
-        for run in group:
-            run_data = pd.DataFrame(group[run][:], columns=['year', 'cluster_uid', 'population'])
-            run_data['run'] = int(run.split('_')[1])
-            run_data = run_data[run_data['year'] % frequency == 0]
-            traj.append(run_data)
-
-        traj = pd.concat(traj, ignore_index=True)
-        return traj
+        runs = sorted(int(run.split('_')[1]) for run in group) if runs is None else runs
+        for run in runs:
+            run_group = group[f'run_{run}']
+            run_years, offsets = run_group['years'][:], run_group['offsets'][:]
+            selected = run_years % frequency == 0
+            if years is not None:
+                selected &= np.isin(run_years, list(years))
+
+            index = np.flatnonzero(selected)
+            pops = [run_group['population'][offsets[i]:offsets[i + 1]] for i in index]
+            uids = [np.arange(len(pop)) for pop in pops]
+            if min_population is not None:
+                masks = [pop >= min_population for pop in pops]
+                pops = [pop[mask] for pop, mask in zip(pops, masks)]
+                uids = [uid[mask] for uid, mask in zip(uids, masks)]
+
+            year = np.repeat(run_years[index], [len(pop) for pop in pops])
+            yield run, year, _concatenate(uids), _concatenate(pops)
+
+
+def _concatenate(arrays: List[np.ndarray]) -> np.ndarray:
+    return np.concatenate(arrays) if arrays else np.empty(0, dtype=np.int64)
+
+
+def iter_multirun_frames(model_name: str, frequency: int = 1, file_path: str = 'simulations.hdf5', runs: Iterable[int] = None, years: Iterable[int] = None,
+                         min_population: float = None) -> Iterator[pd.DataFrame]:
+    for run, year, cluster_uid, population in iter_multirun(model_name=model_name, frequency=frequency, file_path=file_path, runs=runs, years=years,
+                                                            min_population=min_population):
+        yield pd.DataFrame({'year': year, 'cluster_uid': cluster_uid, 'population': population, 'run': run})
+
+
+def load_multirun(model_name: str, frequency: int = 1, file_path: str = 'simulations.hdf5', runs: Iterable[int] = None, years: Iterable[int] = None,
+                  min_population: float = None) -> pd.DataFrame:
+    traj = list(iter_multirun_frames(model_name=model_name, frequency=frequency, file_path=file_path, runs=runs, years=years, min_population=min_population))
+    traj = pd.concat(traj, ignore_index=True)
+    return traj
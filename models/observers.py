@@ -0,0 +1,78 @@
+from abc import ABC, abstractmethod
+from typing import Dict, Sequence
+import numpy as np
+import pandas as pd
+
+from utils import ZipfRegression, run_zipf_regression
+
+
+class Observer(ABC):
+    """
+    Summary statistic computed by Model.run on the population after each step, step 0 being the initial population. Only
+    the statistic is kept, so that a run with store_traj=False needs O(n_steps) memory.
+    """
+    columns: Sequence = None
+
+    def __init__(self):
+        self.values: Dict[int, np.ndarray] = {}
+
+    def observe(self, step: int, pop: np.ndarray) -> None:
+        self.values[step] = np.atleast_1d(self.compute(pop))
+
+    @abstractmethod
+    def compute(self, pop: np.ndarray):
+        pass
+
+    def to_frame(self, start_year: int = 1850) -> pd.DataFrame:
+        frame = pd.DataFrame.from_dict(self.values, orient='index', columns=self.columns)
+        frame.index = start_year + frame.index
+        frame.index.name = 'year'
+        return frame
+
+
+class NumClustersObserver(Observer):
+    columns = ['n_clusters']
+
+    def compute(self, pop: np.ndarray):
+        return len(pop)
+
+
+class ZipfObserver(Observer):
+    columns = list(ZipfRegression._fields)
+
+    def __init__(self, threshold_regression: int = 5 * 10 ** 3):
+        super().__init__()
+        self.threshold_regression = threshold_regression
+
+    def compute(self, pop: np.ndarray):
+        x = pop[pop > self.threshold_regression]
+        if len(x) < 3:
+            return np.array([np.nan] * 4 + [len(x)])
+
+        reg, _ = run_zipf_regression(x=x)
+        return np.array(reg, dtype=np.float64)
+
+
+class TopKObserver(Observer):
+    # Sizes of the k largest clusters, in decreasing order
+    def __init__(self, k: int = 100):
+        super().__init__()
+        self.k = k
+        self.columns = list(range(1, k + 1))
+
+    def compute(self, pop: np.ndarray):
+        if len(pop) <= self.k:
+            return np.sort(pop)[::-1]
+
+        return np.sort(np.partition(pop, len(pop) - self.k)[len(pop) - self.k:])[::-1]
+
+
+class LogSizeHistogramObserver(Observer):
+    # Number of clusters in each bin of log10 population, the columns being the lower edges of the bins
+    def __init__(self, bins: np.ndarray = np.linspace(start=2, stop=8, num=61)):
+        super().__init__()
+        self.bins = bins
+        self.columns = list(bins[:-1])
+
+    def compute(self, pop: np.ndarray):
+        return np.histogram(np.log10(pop), bins=self.bins)[0]
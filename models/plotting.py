@@ -5,8 +5,9 @@ from plotly.subplots import make_subplots
 import plotly.express as px
 import numpy as np
 import statsmodels.api as sm
+from typing import Callable, Iterable, Tuple, Union
 
-from utils import nadaraya_watson_estimator, plot_zipf_regression
+from utils import get_annualized_growth_rate, nadaraya_watson_estimator, plot_zipf_regression
 
 
 def plot_mean_growth_rate_by_size_nd(threshold):
@@ -78,76 +79,109 @@ def plot_zipf():
     fig.update_layout(title='Zipf plots USA cities', font=dict(size=20, color='black'), xaxis_title='Log10(Population)', yaxis_title='Log10(Rank)')
     fig.show()
 
+class HeatmapAccumulator:
+    """
+    2D histogram over fixed bins of the points that statistic extracts from a trajectory frame, accumulated frame by frame,
+    e.g. run by run from multirun.iter_multirun_frames, so that the memory does not depend on the number of runs.
+    """
+    def __init__(self, statistic: Callable[[pd.DataFrame], Tuple[np.ndarray, np.ndarray]], xbins: np.ndarray, ybins: np.ndarray, per_run: bool = False):
+        self.statistic = statistic
+        self.xbins = xbins
+        self.ybins = ybins
+        self.per_run = per_run
+        self.counts = np.zeros((len(xbins) - 1, len(ybins) - 1))
+        self.n_runs = 0
+
+    def add(self, traj: pd.DataFrame) -> None:
+        x, y = self.statistic(traj)
+        self.counts += np.histogram2d(x, y, bins=(self.xbins, self.ybins))[0]
+        self.n_runs += traj['run'].nunique() if 'run' in traj.columns else 1
+
+    def plot(self, fig: go.Figure = None, name: str = '', row: int = None, col: int = None, showscale: bool = False) -> go.Figure:
+        fig = go.Figure() if fig is None else fig
+        counts = self.counts / max(self.n_runs, 1) if self.per_run else self.counts
+        fig.add_trace(go.Heatmap(z=np.log(1 + counts.T), x=self.xbins, y=self.ybins, colorscale='Viridis', name=name, showscale=showscale), row=row, col=col)
+        return fig
+
+
+def _growth_rate_points(traj: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+    gr = traj if 'annualized_growth_rate' in traj.columns else get_annualized_growth_rate(traj).dropna()
+    return np.log10(gr['population']), gr['annualized_growth_rate']
+
+
+def _std_growth_rate_points(traj: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+    gr = traj if 'annualized_growth_rate' in traj.columns else get_annualized_growth_rate(traj).dropna()
+    group_by = [col for col in ['run', 'cluster_uid'] if col in gr.columns]
+    std_growth_rates = gr.groupby(group_by).agg({'annualized_growth_rate': 'std', 'population': 'first'}).rename(columns={'annualized_growth_rate': 'std_annualized_growth_rate'})
+    std_growth_rates = std_growth_rates.dropna()
+    return np.log10(std_growth_rates['population']), std_growth_rates['std_annualized_growth_rate']
+
+
+def _zipf_points(traj: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+    max_year = traj['year'].max()
+    traj = traj[traj['year'] == max_year]
+    rank = traj.groupby(['run'])['population'].rank(ascending=False).astype(np.int64) if 'run' in traj.columns else traj['population'].rank(ascending=False).astype(np.int64)
+    return np.log10(traj['population']), np.log10(rank)
+
+
+def growth_rate_heatmap(nbins: int = 20) -> HeatmapAccumulator:
+    return HeatmapAccumulator(statistic=_growth_rate_points, xbins=np.linspace(2, 7, nbins), ybins=np.linspace(-0.5, 0.5, nbins), per_run=True)
+
+
+def std_growth_rate_heatmap(nbins: int = 20) -> HeatmapAccumulator:
+    return HeatmapAccumulator(statistic=_std_growth_rate_points, xbins=np.linspace(2, 7, nbins), ybins=np.linspace(0, 0.2, nbins))
+
+
+def zipf_heatmap(nbins: int = 20) -> HeatmapAccumulator:
+    return HeatmapAccumulator(statistic=_zipf_points, xbins=np.linspace(2, 7, nbins), ybins=np.linspace(0, 3, nbins))
+
+
 def plot_heatmap_growth_rate(gr: pd.DataFrame, fig: go.Figure = None, name: str = '', nbins: int = 20, row: int = None, col: int = None, showscale: bool = False):
     if fig is None:
         fig = go.Figure()
         fig.update_layout(template='plotly_white', title_text='Annualized growth rate', xaxis_title='Population', yaxis_title='Growth rate')
-    fig = go.Figure() if fig is None else fig
-    n_runs = gr['run'].nunique()
-    xbins = np.linspace(2, 7, nbins)
-    ybins = np.linspace(-0.5, 0.5, nbins)
-    h, xedges, yedges = np.histogram2d(np.log10(gr['population']), gr['annualized_growth_rate'], bins=(xbins, ybins))
-    fig.add_trace(go.Heatmap(z=np.log(1 + h.T/n_runs), x=xedges, y=yedges, colorscale='Viridis', name=name, showscale=showscale), row=row, col=col)
-    return fig
+    heatmap = growth_rate_heatmap(nbins=nbins)
+    heatmap.add(gr)
+    return heatmap.plot(fig=fig, name=name, row=row, col=col, showscale=showscale)
 
 
 def plot_heatmap_std_growth_rate(gr: pd.DataFrame, fig: go.Figure = None, name: str = '', nbins: int = 20, row: int = None, col: int = None, showscale: bool = False):
     if fig is None:
         fig = go.Figure()
         fig.update_layout(template='plotly_white', title_text='Standard deviation of growth rate', xaxis_title='Population', yaxis_title='Standard deviation')
-    std_growth_rates = gr.groupby('cluster_uid').agg({'annualized_growth_rate': 'std', 'population': 'first'}).rename(columns={'annualized_growth_rate': 'std_annualized_growth_rate'})
-    std_growth_rates = std_growth_rates.dropna()
-    xbins = np.linspace(2, 7, nbins)
-    ybins = np.linspace(0, 0.2, nbins)
-    h, xedges, yedges = np.histogram2d(np.log10(std_growth_rates['population']), std_growth_rates['std_annualized_growth_rate'], bins=(xbins, ybins))
-    fig.add_trace(go.Heatmap(z=np.log(1 + h.T), x=xedges, y=yedges, colorscale='Viridis', name=name, showscale=showscale), row=row, col=col)
-    return fig
+    heatmap = std_growth_rate_heatmap(nbins=nbins)
+    heatmap.add(gr)
+    return heatmap.plot(fig=fig, name=name, row=row, col=col, showscale=showscale)
 
 
 def plot_heatmap_zipf(traj: pd.DataFrame, fig: go.Figure = None, name: str = '', nbins: int = 20, row: int = None, col: int = None, showscale: bool = False):
     if fig is None:
         fig = go.Figure()
         fig.update_layout(template='plotly_white', title_text='Zipf plot', xaxis_title='Population', yaxis_title='Rank')
+    heatmap = zipf_heatmap(nbins=nbins)
+    heatmap.add(traj)
+    return heatmap.plot(fig=fig, name=name, row=row, col=col, showscale=showscale)
 
-    def _get_rank(x):
-        rank = x.rank(ascending=False).astype(np.int64)
-        return rank
 
-    max_year = traj['year'].max()
-    traj = traj[traj['year'] == max_year][['run', 'cluster_uid', 'population']].copy()
-    traj['rank'] = traj.groupby(['run'])['population'].transform(_get_rank)
-    xbins = np.linspace(2, 7, nbins)
-    ybins = np.linspace(0, 3, nbins)
-    h, xedges, yedges = np.histogram2d(np.log10(traj['population']), np.log10(traj['rank']), bins=(xbins, ybins))
-    fig.add_trace(go.Heatmap(z=np.log(1 + h.T), x=xedges, y=yedges, colorscale='Viridis', name=name, showscale=showscale), row=row, col=col)
-    return fig
-
-
-def plot_comparison(traj: pd.DataFrame, name: str):
+def plot_comparison(traj: Union[pd.DataFrame, Iterable[pd.DataFrame]], name: str):
+    # traj is either a multirun frame or an iterable of frames, e.g. one per run from multirun.iter_multirun_frames, which are accumulated one at a time
     real = cdb.get_cluster_population()
     real['run'] = 1
 
-    gr_traj = get_annualized_growth_rate(traj).dropna()
+    heatmaps_real, heatmaps_traj = [growth_rate_heatmap(), std_growth_rate_heatmap()], [growth_rate_heatmap(), std_growth_rate_heatmap()]
     gr_real = get_annualized_growth_rate(real).dropna()
+    for heatmap in heatmaps_real:
+        heatmap.add(gr_real)
+    for traj_ in ([traj] if isinstance(traj, pd.DataFrame) else traj):
+        gr_traj = get_annualized_growth_rate(traj_).dropna()
+        for heatmap in heatmaps_traj:
+            heatmap.add(gr_traj)
 
     fig = make_subplots(rows=2, cols=2, subplot_titles=('Real Mean', f'{name} Mean', 'Real Std', f'{name} Std'), vertical_spacing=0.05, horizontal_spacing=0.05, shared_yaxes=True, shared_xaxes=True)
-    fig = plot_heatmap_growth_rate(gr_real, fig=fig, row=1, col=1)
-    fig = plot_heatmap_growth_rate(gr_traj, fig=fig, row=1, col=2)
-    fig = plot_heatmap_std_growth_rate(gr_traj, fig=fig, row=2, col=1)
-    fig = plot_heatmap_std_growth_rate(gr_real, fig=fig, row=2, col=2)
+    fig = heatmaps_real[0].plot(fig=fig, row=1, col=1)
+    fig = heatmaps_traj[0].plot(fig=fig, row=1, col=2)
+    fig = heatmaps_traj[1].plot(fig=fig, row=2, col=1)
+    fig = heatmaps_real[1].plot(fig=fig, row=2, col=2)
     fig.update_layout(template='plotly_white', title_text='Annualized growth rate')
 
     fig.show()
-
-def get_annualized_growth_rate(traj):
-    def _growth_rate(x):
-        if len(x) < 2:
-            return np.nan
-        g = -1 * x.diff(-1) / x
-        return g
-
-    traj = traj.sort_values(by=['run', 'cluster_uid', 'year'])
-    traj['growth_rate'] = traj.groupby(['run', 'cluster_uid'])['population'].transform(_growth_rate)
-    ydiff = -1 * traj['year'].diff(-1)
-    traj['annualized_growth_rate'] = np.power(1 + traj['growth_rate'], 1/ydiff) - 1
-    return traj
\ No newline at end of file
@@ -0,0 +1,35 @@
+from typing import Callable
+import numpy as np
+
+
+def sample_normal_growth_rate(pop: np.ndarray, mean_growth_rate: Callable[[np.ndarray], np.ndarray], std_growth_rate: Callable[[np.ndarray], np.ndarray], rng=np.random) -> np.ndarray:
+    # The fitted curves are evaluated on the whole population at once and all the normals are drawn in a single call.
+    # The normals are drawn in the same order as one np.random.normal call per city, so a fixed seed gives the same result.
+    growth_rate = 1 + rng.normal(loc=mean_growth_rate(pop), scale=std_growth_rate(pop))
+    growth_rate = np.clip(growth_rate, 0, np.inf)
+    return growth_rate
+
+
+def sample_symmetric_levy_stable(alpha: np.ndarray, loc: np.ndarray, scale: np.ndarray, rng=np.random) -> np.ndarray:
+    # Chambers-Mallows-Stuck sampler for symmetric (beta = 0) stable laws, where the S0 and S1 parametrisations coincide.
+    # It is elementwise in alpha, so any shock exponent curve is supported, and alpha = 1 (Cauchy) and alpha = 2 (Gaussian with variance 2 * scale ** 2) need no special case.
+    alpha, loc, scale = np.broadcast_arrays(alpha, loc, scale)
+    v = rng.uniform(low=-np.pi / 2, high=np.pi / 2, size=alpha.shape)
+    w = rng.exponential(size=alpha.shape)
+    x = np.sin(alpha * v) / np.power(np.cos(v), 1 / alpha) * np.power(np.cos((1 - alpha) * v) / w, (1 - alpha) / alpha)
+    return loc + scale * x
+
+
+def sample_levy_stable_growth_rate(pop: np.ndarray, mean_growth_rate: Callable[[np.ndarray], np.ndarray], std_growth_rate: Callable[[np.ndarray], np.ndarray],
+                                   shock_exponent: Callable[[np.ndarray], np.ndarray], rng=np.random) -> np.ndarray:
+    growth_rate = 1 + sample_symmetric_levy_stable(alpha=shock_exponent(pop), loc=mean_growth_rate(pop), scale=std_growth_rate(pop), rng=rng)
+    growth_rate = np.clip(growth_rate, 0, np.inf)
+    return growth_rate
+
+
+def sample_categories(probability: np.ndarray, size: int, rng=np.random) -> np.ndarray:
+    # Inverse-CDF search with the same uniforms as np.random.choice(len(probability), size=size, p=probability), hence the same draws,
+    # but without the validation and normalisation of the probability vector that np.random.choice repeats on every call
+    cdf = np.cumsum(probability)
+    cdf /= cdf[-1]
+    return np.searchsorted(cdf, rng.random(size), side='right')
@@ -0,0 +1,90 @@
+from typing import Iterable, Iterator, Mapping
+import json
+import os
+import numpy as np
+import pandas as pd
+
+
+class TrajectoryBuffer(Mapping):
+    """
+    Read-only mapping from steps to populations, stored one after the other in a single preallocated array which grows
+    geometrically when it is full. Steps are appended by Model.run, and a step is returned as a read-only view.
+    """
+    def __init__(self, capacity: int = 0):
+        self._population = np.empty(capacity, dtype=np.float64)
+        self._offsets = [0]
+        self._index = {}
+
+    def append(self, step: int, pop: np.ndarray) -> None:
+        start, end = self._offsets[-1], self._offsets[-1] + len(pop)
+        if end > len(self._population):
+            population = np.empty(max(end, 2 * len(self._population)), dtype=np.float64)
+            population[:start] = self._population[:start]
+            self._population = population
+
+        self._population[start:end] = pop
+        self._offsets.append(end)
+        self._index[step] = len(self._index)
+
+    def __getitem__(self, step: int) -> np.ndarray:
+        i = self._index[step]
+        pop = self._population[self._offsets[i]:self._offsets[i + 1]]
+        pop.flags.writeable = False
+        return pop
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._index)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __getstate__(self):
+        # The unused capacity is not pickled, e.g. when a trajectory is sent back by a worker process
+        state = self.__dict__.copy()
+        state['_population'] = self._population[:self._offsets[-1]]
+        return state
+
+
+def save_trajectory(traj: Mapping[int, np.ndarray], file_path: str) -> None:
+    """
+    Save a trajectory to the directory file_path, as a flat population.npy array with the populations of all the steps
+    one after the other, and steps.npy and offsets.npy such that the populations of steps[i] are
+    population[offsets[i]:offsets[i + 1]].
+    """
+    os.makedirs(file_path, exist_ok=True)
+    steps = np.array(list(traj.keys()), dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum([len(pop) for pop in traj.values()])]).astype(np.int64)
+    population = np.lib.format.open_memmap(os.path.join(file_path, 'population.npy'), mode='w+', dtype=np.float64, shape=(int(offsets[-1]),))
+    for i, pop in enumerate(traj.values()):
+        population[offsets[i]:offsets[i + 1]] = pop
+
+    population.flush()
+    np.save(os.path.join(file_path, 'steps.npy'), steps)
+    np.save(os.path.join(file_path, 'offsets.npy'), offsets)
+
+
+def load_trajectory(file_path: str, frequency: int = None, steps: Iterable[int] = None, start_year: int = 1850) -> pd.DataFrame:
+    # The steps are selected by steps if given, else by frequency, every 10th step by default as in the JSON loader.
+    # The populations are memory-mapped, so only the selected steps are read from disk.
+    population = np.load(os.path.join(file_path, 'population.npy'), mmap_mode='r')
+    traj_steps, offsets = np.load(os.path.join(file_path, 'steps.npy')), np.load(os.path.join(file_path, 'offsets.npy'))
+    if steps is not None:
+        selected = np.isin(traj_steps, list(steps))
+    else:
+        selected = traj_steps % (10 if frequency is None else frequency) == 0
+
+    traj_data = [pd.DataFrame({'year': np.empty(0, dtype=np.int64), 'cluster_uid': np.empty(0, dtype=np.int64), 'population': np.empty(0, dtype=population.dtype)})]
+    for i in np.flatnonzero(selected):
+        pop = np.array(population[offsets[i]:offsets[i + 1]])
+        traj_data.append(pd.DataFrame({'year': start_year + traj_steps[i] * np.ones(len(pop), dtype=np.int64), 'cluster_uid': np.arange(len(pop)), 'population': pop}))
+
+    traj_data = pd.concat(traj_data, ignore_index=True)
+    return traj_data
+
+
+def convert_json_trajectory(json_path: str, file_path: str) -> None:
+    # Convert a trajectory saved as JSON by earlier versions of Model.save_traj
+    with open(json_path, 'r') as f:
+        traj = json.load(f)
+
+    save_trajectory({int(step): np.asarray(pop, dtype=np.float64) for step, pop in traj.items()}, file_path)
@@ -1,18 +1,18 @@
-from typing import List, Dict, Tuple, Callable
+from typing import List, Dict, Sequence, Tuple, Callable
 
 import numpy as np
 import pandas as pd
-import json
 from statsmodels.tsa import ar_model
 import clusterdb as cdb
-from utils import remove_outliers, nadaraya_watson_estimator, plot_zipf_regression
+from utils import get_annualized_growth_rate, remove_outliers, nadaraya_watson_estimator, plot_zipf_regression
+from trajectory import load_trajectory
 
 
 def fit_mean_growth_rate(years: Tuple[int, int] = None):
     growth_measure = 'annualized_growth_rate'
     q = 0.00001
     growth = cdb.get_cluster_growth_rate(years=years)
-    remove_outliers(data=growth, col_name=growth_measure, q=q)
+    growth = remove_outliers(data=growth, col_name=growth_measure, q=q)
     nd_estimator_growth = nadaraya_watson_estimator(data=growth, x_name='population', y_name=growth_measure, nbins=100)
     x, y = nd_estimator_growth.index.values, nd_estimator_growth[f'mean_{growth_measure}'].values
 
@@ -22,63 +22,63 @@ def fit_mean_growth_rate(years: Tuple[int, int] = None):
     return mean_growth_rate
 
 
-def load_trajectory(file_path: str) -> pd.DataFrame:
-    with open(file_path, 'r') as f:
-        traj = json.load(f)
+def compute_autocorrelation(traj: pd.DataFrame, group_by: Sequence[str] = None) -> pd.DataFrame:
+    # Lag-1 autocorrelation of the annualized growth rates of each cluster, NaN for clusters with fewer than 4 growth rates
+    traj = get_annualized_growth_rate(traj, group_by=group_by)
+    keys, starts = _group_starts(traj, group_by=group_by)
+    growth = traj['annualized_growth_rate'].to_numpy()
+    valid = ~np.isnan(growth)
+    dot, norm_lag, norm_lead, n_valid = _lag_sums(growth[valid], starts=np.cumsum(np.append(0, valid))[starts])
 
-    traj_data = []
-    for y in traj.keys():
-        if int(y) % 10 == 0:
-            pop = traj[y]
-            ids = np.arange(len(pop))
-            traj_data.append(pd.DataFrame({'year': 1850 + int(y) * np.ones(len(pop), dtype=np.int64), 'cluster_uid': ids, 'population': pop}))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        autocorrelation = np.where(n_valid >= 4, dot / np.sqrt(norm_lag * norm_lead), np.nan)
 
-    traj_data = pd.concat(traj_data, ignore_index=True)
-    return traj_data
-
-
-def get_annualized_growth_rate(traj):
-    def _growth_rate(x):
-        if len(x) < 2:
-            return np.nan
-        g = -1 * x.diff(-1) / x
-        return g
-
-    traj = traj.sort_values(by=['cluster_uid', 'year'])
-    traj['growth_rate'] = traj.groupby('cluster_uid')['population'].transform(_growth_rate)
-    ydiff = -1 * traj['year'].diff(-1)
-    traj['annualized_growth_rate'] = np.power(1 + traj['growth_rate'], 1/ydiff) - 1
-    return traj
-
-
-def compute_autocorrelation(traj: pd.DataFrame):
-    traj = get_annualized_growth_rate(traj)
-    def _autocorrelation(x):
-        x_ = x.dropna().values
-        if len(x_) < 4:
-            return np.nan
-        corr = x_[:-1].dot(x_[1:]) / (np.linalg.norm(x_[:-1]) * np.linalg.norm(x_[1:]))
-        return corr
-
-    autocorr = traj.groupby('cluster_uid').agg({'annualized_growth_rate': _autocorrelation, 'population': 'first'}).reset_index()
-    autocorr = autocorr.rename(columns={'annualized_growth_rate': 'autocorrelation'})
+    autocorr = keys.assign(autocorrelation=autocorrelation, population=traj['population'].to_numpy()[starts])
     return autocorr
 
 
-def compute_autocorrelation_mean_growth(traj: pd.DataFrame):
-    traj = get_annualized_growth_rate(traj)
-    mean_growth = fit_mean_growth_rate()
-
-    def _autocorrelation_with_mean_growth(x):
-        if len(x) < 3:
-            return np.nan
-        g = np.array([mean_growth(size) for size in x['population'].values[:-1]])
-        x_ = x['annualized_growth_rate'].dropna().values - g
-        corr = x_[:-1].dot(x_[1:]) # / (np.linalg.norm(x_[:-1]) * np.linalg.norm(x_[1:]))
-        return corr
-
-
-    autocorr_mean_growth = traj.groupby('cluster_uid').apply(_autocorrelation_with_mean_growth).to_frame(name='autocorrelation')
-    pop = traj.groupby('cluster_uid')['population'].first()
-    autocorr_mean_growth = pd.concat([autocorr_mean_growth, pop], axis=1)
-    return autocorr_mean_growth
\ No newline at end of file
+def compute_autocorrelation_mean_growth(traj: pd.DataFrame, mean_growth: Callable[[np.ndarray], np.ndarray] = None, group_by: Sequence[str] = None) -> pd.DataFrame:
+    # Lag-1 autocovariance of the growth rates of each cluster around the mean growth rate of its size, NaN for clusters with fewer than 3 rows.
+    # The mean growth rate curve is fitted from clusterdb only if it is not given.
+    traj = get_annualized_growth_rate(traj, group_by=group_by)
+    mean_growth = fit_mean_growth_rate() if mean_growth is None else mean_growth
+    keys, starts = _group_starts(traj, group_by=group_by)
+    growth = traj['annualized_growth_rate'].to_numpy()
+    valid = ~np.isnan(growth)
+    residual = growth[valid] - mean_growth(traj['population'].to_numpy()[valid])
+    dot, _, _, _ = _lag_sums(residual, starts=np.cumsum(np.append(0, valid))[starts])
+
+    n_rows = np.diff(np.append(starts, len(traj)))
+    autocorr_mean_growth = keys.assign(autocorrelation=np.where(n_rows >= 3, dot, np.nan), population=traj['population'].to_numpy()[starts])
+    return autocorr_mean_growth.set_index(list(keys.columns))
+
+
+def _group_starts(traj: pd.DataFrame, group_by: Sequence[str] = None) -> Tuple[pd.DataFrame, np.ndarray]:
+    # Keys and first row of each group of traj, which must be sorted by group as returned by get_annualized_growth_rate
+    group_by = [col for col in ['run', 'cluster_uid'] if col in traj.columns] if group_by is None else list(group_by)
+    new_group = np.zeros(len(traj), dtype=bool)
+    new_group[:1] = True
+    for col in group_by:
+        keys = traj[col].to_numpy()
+        new_group[1:] |= keys[1:] != keys[:-1]
+
+    starts = np.flatnonzero(new_group)
+    return traj[group_by].iloc[starts].reset_index(drop=True), starts
+
+
+def _lag_sums(x: np.ndarray, starts: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # Sums of x[t] * x[t + 1], x[t] ** 2 and x[t + 1] ** 2 within each of the consecutive segments of x starting at starts, and segment lengths.
+    # The pairs straddling two segments are zeroed, and np.add.reduceat reduces all the segments in one pass.
+    n = np.diff(np.append(starts, len(x)))
+    if len(x) < 2:
+        return np.zeros(len(starts)), np.zeros(len(starts)), np.zeros(len(starts)), n
+
+    same_segment = np.ones(len(x) - 1, dtype=bool)
+    same_segment[starts[(starts > 0) & (starts < len(x))] - 1] = False
+    lag, lead = np.where(same_segment, x[:-1], 0), np.where(same_segment, x[1:], 0)
+    # The pairs are padded to len(x) so that segment i is [starts[i], starts[i + 1]) in both arrays. reduceat returns the value at the start of an
+    # empty segment instead of 0, and segments of one value have no pair, hence the mask.
+    has_pairs = n >= 2
+    pair_starts = np.minimum(starts, len(x) - 1)
+    sums = [np.where(has_pairs, np.add.reduceat(np.append(values, 0), pair_starts), 0) for values in (lag * lead, lag ** 2, lead ** 2)]
+    return sums[0], sums[1], sums[2], n
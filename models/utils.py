@@ -1,62 +1,117 @@
 import numpy as np
 import pandas as pd
-import statsmodels.api as sm
-from typing import Tuple
+from typing import Dict, NamedTuple, Sequence, Tuple, Union
 import plotly.graph_objects as go
 
 
-def nadaraya_watson_estimator(data: pd.DataFrame, x_name: str, y_name: str, nbins: int, h: float = 1) -> pd.DataFrame:
-    # Use the same notation as in the PNAS paper "Laws of population growth" by Rozenfeld et al., but lowercase
+def nadaraya_watson_estimator(data: pd.DataFrame, x_name: str, y_name: str, nbins: int, h: float = 1, chunk_size: int = 2 ** 14) -> pd.DataFrame:
+    return nadaraya_watson_estimators(data=data, x_name=x_name, y_name=y_name, nbins=nbins, hs=[h], chunk_size=chunk_size)[h]
+
+
+def nadaraya_watson_estimators(data: pd.DataFrame, x_name: str, y_name: str, nbins: int, hs: Sequence[float], chunk_size: int = 2 ** 14) -> Dict[float, pd.DataFrame]:
+    # Use the same notation as in the PNAS paper "Laws of population growth" by Rozenfeld et al., but lowercase.
+    # The kernel is evaluated on chunk_size clusters at a time, so memory is O(nbins * chunk_size) rather than O(nbins * N), and the distances
+    # between bins and clusters are computed once for all the bandwidths in hs. The variance is accumulated around the overall mean of y_name,
+    # which keeps the one-pass formula from cancelling out.
     lower_bound, upper_bound = 0.9 * data[x_name].min(), 1.1 * data[x_name].max()
 
     s0 = np.logspace(start=np.log10(lower_bound), stop=np.log10(upper_bound), num=nbins, base=10)
     sit0 = data[x_name].values
     ris0 = data[y_name].values
+    shift = ris0.mean()
 
-    s0_m = np.outer(s0, np.ones_like(sit0))
-    sit0_m = np.outer(np.ones_like(s0), sit0)
-    kh = np.exp(-1 * (np.log(s0_m) - np.log(sit0_m)) ** 2 / (2 * h ** 2))
+    hs = list(hs)
+    sum_kn_across_clusters, sum_kn_ris0, sum_kn_ris0_sq = np.zeros((len(hs), nbins)), np.zeros((len(hs), nbins)), np.zeros((len(hs), nbins))
+    for start in range(0, len(sit0), chunk_size):
+        sq_log_dist = (np.log(s0)[:, None] - np.log(sit0[start:start + chunk_size])[None, :]) ** 2
+        ris0_ = ris0[start:start + chunk_size] - shift
+        for i, h in enumerate(hs):
+            kh = np.exp(-1 * sq_log_dist / (2 * h ** 2))
+            sum_kn_across_clusters[i] += kh.sum(axis=1)
+            sum_kn_ris0[i] += kh @ ris0_
+            sum_kn_ris0_sq[i] += kh @ ris0_ ** 2
 
-    sum_kn_across_clusters = kh.sum(axis=1)
+    estimate_mean = sum_kn_ris0 / sum_kn_across_clusters
+    estimate_variance = np.clip(sum_kn_ris0_sq / sum_kn_across_clusters - estimate_mean ** 2, 0, np.inf)
 
-    estimate_mean = (kh @ ris0) / sum_kn_across_clusters
+    estimates = {}
+    for i, h in enumerate(hs):
+        estimate = pd.DataFrame({'bin': s0, f'mean_{y_name}': shift + estimate_mean[i], f'std_{y_name}': np.sqrt(estimate_variance[i])})
+        estimate.set_index('bin', inplace=True)
+        estimates[h] = estimate
 
-    ris0_m = np.outer(ris0, np.ones_like(s0))
-    estimate_mean_m = np.outer(np.ones_like(ris0), estimate_mean)
-    estimate_variance = np.diag((kh @ np.power(ris0_m - estimate_mean_m, 2)) / sum_kn_across_clusters)
+    return estimates
 
-    estimate = pd.DataFrame({'bin': s0, f'mean_{y_name}': estimate_mean, f'std_{y_name}': np.sqrt(estimate_variance)})
-    estimate.set_index('bin', inplace=True)
-    return estimate
+
+def outlier_mask(values: np.ndarray, q: float = 0.001) -> np.ndarray:
+    # Both quantiles are computed in a single pass, NaNs being ignored as in pandas, and are excluded from the mask along with the NaNs
+    ql, qh = np.nanquantile(values, [q, 1 - q])
+    return (values > ql) & (values < qh)
 
 
 def remove_outliers(data: pd.DataFrame, col_name: str, q: float = 0.001) -> pd.DataFrame:
-    qh = data[col_name].quantile(1 - q)
-    ql = data[col_name].quantile(q)
-    data = data[(data[col_name] < qh) & (data[col_name] > ql)]
+    data = data[outlier_mask(data[col_name].values, q=q)]
     return data
 
 
-def plot_zipf_regression(population: pd.DataFrame, color: pd.DataFrame = None, text: pd.DataFrame = None, fig: go.Figure = None, row: int = None, col: int = None, name='Population', title: str = 'Zipf regression', plot_annotation: bool = True, show_scatter_label: bool = True,
-                         plot_theory: bool = True, plot_regression: bool = True, threshold_regression: int = 5*10**3) -> go.Figure:
+def get_annualized_growth_rate(traj: pd.DataFrame, group_by: Sequence[str] = None) -> pd.DataFrame:
+    # Sorts by (group_by, year) and compares each row with the next one, which belongs to the same cluster unless the row is the last of its group.
+    # group_by defaults to the run and cluster_uid columns present in traj. The last row of each group gets NaN growth rates.
+    group_by = [col for col in ['run', 'cluster_uid'] if col in traj.columns] if group_by is None else list(group_by)
+    traj = traj.sort_values(by=group_by + ['year'])
+    pop = traj['population'].to_numpy(dtype=np.float64)
+    year = traj['year'].to_numpy(dtype=np.float64)
+
+    same_group = np.zeros(len(traj), dtype=bool)
+    same_group[:-1] = True
+    for col in group_by:
+        keys = traj[col].to_numpy()
+        same_group[:-1] &= keys[1:] == keys[:-1]
+
+    growth_rate, ydiff = np.full(len(traj), np.nan), np.full(len(traj), np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        growth_rate[:-1] = (pop[1:] - pop[:-1]) / pop[:-1]
+        ydiff[:-1] = year[1:] - year[:-1]
+        growth_rate[~same_group] = np.nan
+        ydiff[~same_group] = np.nan
+        traj['growth_rate'] = growth_rate
+        traj['annualized_growth_rate'] = np.power(1 + growth_rate, 1 / ydiff) - 1
+
+    return traj
+
+
+def plot_zipf_regression(population: pd.DataFrame, color: Union[str, pd.DataFrame] = None, text: pd.DataFrame = None, fig: go.Figure = None, row: int = None, col: int = None, name='Population', title: str = 'Zipf regression', plot_annotation: bool = True, show_scatter_label: bool = True,
+                         plot_theory: bool = True, plot_regression: bool = True, threshold_regression: int = 5*10**3, max_points: int = None) -> go.Figure:
+    # color is either a single color or a frame with a color per city. With max_points, only the cities at max_points log-spaced ranks are drawn,
+    # which keeps the largest cities and the tail while bounding the size of the figure. The regression always uses all the cities.
     assert 'population' in population.columns, 'population must be a column of population'
     assert len(population) > 0, 'population must be a non-empty dataframe'
 
     x = population[population['population'] > threshold_regression]['population'].values
     reg, start_point = run_zipf_regression(x=x)
-    intercept, slope, r2, adj_r2 = reg.params[0], reg.params[1], reg.rsquared, reg.rsquared_adj
-
-    color_ = color if color is not None else pd.DataFrame(np.array(['black'] * len(population)).reshape(-1, 1), columns=['color'], index=population.index)
-    text_ = text if text is not None else pd.DataFrame(np.array([''] * len(population)).reshape(-1, 1), columns=['text'], index=population.index)
-    data = pd.concat([population, color_, text_], axis=1)
-    data.sort_values(by='population', ascending=False, inplace=True)
+    intercept, slope, r2, adj_r2 = reg.intercept, reg.slope, reg.rsquared, reg.rsquared_adj
+
+    color_ = 'black' if color is None else color
+    data = population[['population']]
+    if not isinstance(color_, str):
+        data = pd.concat([data, color_], axis=1)
+    if text is not None:
+        data = pd.concat([data, text], axis=1)
+    data = data.sort_values(by='population', ascending=False)
     data['rank'] = np.arange(len(data)) + 1
 
+    n_cities = len(data)
+    if max_points is not None and n_cities > max_points:
+        ranks = np.unique(np.round(np.logspace(start=0, stop=np.log10(n_cities), num=max_points)).astype(np.int64))
+        data = data.iloc[ranks - 1].copy()
+
+    marker_color = color_ if isinstance(color_, str) else data['color']
+    line_color = color_ if isinstance(color_, str) else data['color'].iloc[0]
     data['log10_pop'] = np.log10(data['population'])
     data['log10_rank'] = np.log10(data['rank'])
     log10 = np.log(10)
-    trace_zipf_scatter = go.Scatter(x=data['log10_pop'], y=data['log10_rank'], mode='markers', name=name, text=data['text'], marker=dict(color=data['color']), showlegend=show_scatter_label)
-    trace_zipf_line = go.Scatter(x=data['log10_pop'], y=slope * (data['log10_pop'] - start_point / log10) + intercept / log10, mode='lines', name=f'{name}--S: {np.round(slope, decimals=3)}', line=dict(color=data['color'].iloc[0]), showlegend=True)
+    trace_zipf_scatter = go.Scatter(x=data['log10_pop'], y=data['log10_rank'], mode='markers', name=name, text=data['text'] if text is not None else None, marker=dict(color=marker_color), showlegend=show_scatter_label)
+    trace_zipf_line = go.Scatter(x=data['log10_pop'], y=slope * (data['log10_pop'] - start_point / log10) + intercept / log10, mode='lines', name=f'{name}--S: {np.round(slope, decimals=3)}', line=dict(color=line_color), showlegend=True)
 
     fig.add_trace(trace_zipf_scatter, row=row, col=col)
 
@@ -64,7 +119,7 @@ def plot_zipf_regression(population: pd.DataFrame, color: pd.DataFrame = None, t
         fig.add_trace(trace_zipf_line, row=row, col=col)
 
     if plot_theory:
-        trace_theory = go.Scatter(x=data['log10_pop'], y=-1 * (data['log10_pop'] - start_point / log10) + np.log10(len(data)), mode='lines', name=f'{name}--Theory 1', showlegend=True, line=dict(color='black', dash='dash'))
+        trace_theory = go.Scatter(x=data['log10_pop'], y=-1 * (data['log10_pop'] - start_point / log10) + np.log10(n_cities), mode='lines', name=f'{name}--Theory 1', showlegend=True, line=dict(color='black', dash='dash'))
         fig.add_trace(trace_theory, row=row, col=col)
 
     fig.update_layout(template='plotly_white', title_text=title, font=dict(size=25, color='black'))
@@ -78,14 +133,59 @@ def plot_zipf_regression(population: pd.DataFrame, color: pd.DataFrame = None, t
     return fig
 
 
-def run_zipf_regression(x: np.ndarray) -> Tuple[sm.regression.linear_model.RegressionResults, int]:
-    x_ = sorted(x, reverse=True)
+class ZipfRegression(NamedTuple):
+    intercept: float
+    slope: float
+    rsquared: float
+    rsquared_adj: float
+    nobs: int
+
+
+def run_zipf_regression(x: np.ndarray) -> Tuple[ZipfRegression, float]:
+    x_ = np.sort(x)[::-1]
     log_sorted_x = np.log(x_) - np.log(x_[-1])
     log_rank_x = np.log(np.arange(len(log_sorted_x)) + 1)
     reg = _fit_regression(x=log_sorted_x, y=log_rank_x)
     return reg, np.log(x_[-1])
 
 
-def _fit_regression(x, y):
-    reg = sm.OLS(y, sm.add_constant(x)).fit()
-    return reg
\ No newline at end of file
+def _fit_regression(x: np.ndarray, y: np.ndarray) -> ZipfRegression:
+    # Closed-form OLS of y on x with an intercept, with the same estimates and R2 as statsmodels
+    x_c, y_c = x - x.mean(), y - y.mean()
+    sxx, sxy, syy = x_c @ x_c, x_c @ y_c, y_c @ y_c
+    slope = sxy / sxx
+    r2 = slope * sxy / syy
+    return ZipfRegression(intercept=y.mean() - slope * x.mean(), slope=slope, rsquared=r2, rsquared_adj=1 - (1 - r2) * (len(x) - 1) / (len(x) - 2), nobs=len(x))
+
+
+def run_zipf_regressions(traj: pd.DataFrame, group_by: Sequence[str] = ('run', 'year'), threshold_regression: int = 5 * 10 ** 3) -> pd.DataFrame:
+    # Zipf regression of each group of traj, e.g. of every (run, year) of a multirun, with the same results as run_zipf_regression on each group.
+    # The clusters of all the groups are sorted once, and the regressions reduce to per-group sums computed with np.bincount.
+    group_by = list(group_by)
+    traj = traj[traj['population'] > threshold_regression].sort_values(by=group_by + ['population'], ascending=[True] * len(group_by) + [False])
+    pop = traj['population'].to_numpy(dtype=np.float64)
+
+    new_group = np.zeros(len(traj), dtype=bool)
+    new_group[:1] = True
+    for col in group_by:
+        keys = traj[col].to_numpy()
+        new_group[1:] |= keys[1:] != keys[:-1]
+
+    group = np.cumsum(new_group) - 1
+    starts = np.flatnonzero(new_group)
+    nobs = np.diff(np.append(starts, len(traj)))
+    ends = starts + nobs - 1
+
+    x = np.log(pop) - np.log(pop[ends])[group]
+    y = np.log(np.arange(len(traj)) - starts[group] + 1)
+    x_mean, y_mean = np.bincount(group, weights=x) / nobs, np.bincount(group, weights=y) / nobs
+    x_c, y_c = x - x_mean[group], y - y_mean[group]
+    sxx, sxy, syy = np.bincount(group, weights=x_c * x_c), np.bincount(group, weights=x_c * y_c), np.bincount(group, weights=y_c * y_c)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = sxy / sxx
+        r2 = slope * sxy / syy
+        regressions = traj[group_by].iloc[starts].reset_index(drop=True).assign(intercept=y_mean - slope * x_mean, slope=slope, rsquared=r2,
+                                                                                 rsquared_adj=1 - (1 - r2) * (nobs - 1) / (nobs - 2), nobs=nobs)
+
+    return regressions.set_index(group_by)
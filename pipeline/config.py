@@ -42,7 +42,6 @@ class PathManager:
         class GhslTimeConsistentCluster:
             def __init__(self, sql_file_folder: str):
                 self.sql_file_folder = sql_file_folder
-                self.create_cluster = f"{self.sql_file_folder}/create_cluster.sql"
                 self.create_time_consistent_cluster = f"{self.sql_file_folder}/create_time_consistent_cluster.sql"
                 self.country_geocoding = f"{self.sql_file_folder}/country_geocoding.sql"
 
@@ -68,6 +67,9 @@ class PathManager:
         self.source_data = self.Data(data_folder=data_folder, docker_data_folder=docker_data_folder)
         self.sql = self.SQL(sql_file_folder=f"{self.project_path}/src/sql")
         self.bash = self.Bash(bash_file_folder=f"{self.project_path}/src/bash")
+        self.manifest = f"{data_folder}/tmp/pipeline_manifest.json"
+        self.cluster_labels = f"{data_folder}/tmp/cluster_labels_{{dataset}}_{{year}}.npy"
+        self.raster_memmap = f"{data_folder}/tmp/{{raster_table}}.npy"
 
 
 class DatabaseInfoManager:
@@ -79,6 +81,7 @@ class DatabaseInfoManager:
             self.geo = "geo_{year}"
             self.census = "census_{year}"
             self.census_place_industry_count = "census_place_industry_count_{year}"
+            self.cluster_geometry = "cluster_geometry_{year}"
             self.cluster = "cluster_{year}"
             self.cluster_industry = "cluster_industry_{year}"
             self.rasterized_census_places = "rasterized_census_places_{year}"
@@ -122,6 +125,10 @@ class DatabaseInfoManager:
         self.ipums_postgres_uri = f'postgresql+psycopg2://{self.postgres_user}:{self.postgres_password}@{self.postgres_host}:{self.postgres_port}/{self.ipums_postgres_db_name}'
         self.ghsl_postgres_uri = f'postgresql+psycopg2://{self.postgres_user}:{self.postgres_password}@{self.postgres_host}:{self.postgres_port}/{self.ghsl_postgres_db_name}'
 
+        # Maximum number of per-year tasks of a stage run at once on each database. DuckDB already parallelises each query, and a single writer avoids
+        # contention on its file, while each PostgreSQL backend uses one core.
+        self.max_workers = {'temp_duckdb': 1, 'clusterdb_postgres': os.cpu_count(), 'ghsl_postgres': os.cpu_count()}
+
         self.ipums_table = self.IpumsTableName()
         self.ghsl_table = self.GhslTableName()
 
@@ -130,8 +137,7 @@ class ParameterManager:
     class Ipums:
         def __init__(self):
             self.years = [1850, 1860, 1870, 1880, 1900, 1910, 1920, 1930, 1940]
-            self.dbscan_eps = 100
-            self.dbscan_min_points = 1
+            self.raster_tile_size = 1024
             self.pixel_threshold = 100
             self.convolution_kernel_size = 11
             self.convolution_kernel_decay_rate = 0.2
@@ -140,8 +146,9 @@ class ParameterManager:
         def __init__(self):
             self.years = [1975, 1980, 1985, 1990, 1995, 2000, 2005, 2010, 2015, 2020]
             self.lower_bound_urban = 21
-            self.dbscan_eps = 1
-            self.dbscan_min_points = 1
+            self.cluster_tile_size = 4096
+            # Clusters are labeled in this process on the global grid, with a label grid of several GB on disk per year, so only a few years at once
+            self.cluster_max_workers = 1
 
     def __init__(self):
         self.ipums = self.Ipums()
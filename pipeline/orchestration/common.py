@@ -1,12 +1,21 @@
 from typing import List
+import functools
+import inspect
 from sqlalchemy import text
 import pandas as pd
 
-from src.python.utils import DB, get_db_engine
+from src.python.utils import DB, get_db_engine, run_stage, get_stage_name
 from src.python.multi_year_matching import get_cluster_year_connected_component_table
 
 
 def create_multiyear_table(base_table_name: str, multiyear_cluster_table_name: str, column_names: List[str], years: List[int], create_spatial_index: bool, db: DB):
+    run = functools.partial(_create_multiyear_table, base_table_name, multiyear_cluster_table_name, column_names, years, create_spatial_index, db)
+    run_stage(stage=get_stage_name(create_multiyear_table, db.value, multiyear_cluster_table_name), db=db, run=run, sources=[inspect.getsource(_create_multiyear_table)],
+              params={'column_names': column_names, 'years': years, 'create_spatial_index': create_spatial_index},
+              inputs=[(db, base_table_name.format(year=y)) for y in years], outputs=[multiyear_cluster_table_name])
+
+
+def _create_multiyear_table(base_table_name: str, multiyear_cluster_table_name: str, column_names: List[str], years: List[int], create_spatial_index: bool, db: DB):
     query = ""
     for i, y in enumerate(years):
         query_year = (f"SELECT {y} as year, {', '.join(column_names)} "
@@ -28,6 +37,12 @@ def create_multiyear_table(base_table_name: str, multiyear_cluster_table_name: s
 
 
 def create_cluster_intersection_matching(db: DB, cluster_intersection_matching_table_name: str, multiyear_cluster_table_name: str) -> None:
+    run = functools.partial(_create_cluster_intersection_matching, db, cluster_intersection_matching_table_name, multiyear_cluster_table_name)
+    run_stage(stage=get_stage_name(create_cluster_intersection_matching, db.value, cluster_intersection_matching_table_name), db=db, run=run,
+              sources=[inspect.getsource(_create_cluster_intersection_matching)], params={}, inputs=[(db, multiyear_cluster_table_name)], outputs=[cluster_intersection_matching_table_name])
+
+
+def _create_cluster_intersection_matching(db: DB, cluster_intersection_matching_table_name: str, multiyear_cluster_table_name: str) -> None:
     e = get_db_engine(db=db)
     with e.begin() as conn:
         conn.execute(text(f"DROP TABLE IF EXISTS {cluster_intersection_matching_table_name}"))
@@ -40,6 +55,13 @@ def create_cluster_intersection_matching(db: DB, cluster_intersection_matching_t
 
 
 def create_crosswalk_cluster_uid_to_cluster_id(db: DB, intersection_matching_table_name: str, crosswalk_cluster_uid_to_cluster_id_table_name: str) -> None:
+    run = functools.partial(_create_crosswalk_cluster_uid_to_cluster_id, db, intersection_matching_table_name, crosswalk_cluster_uid_to_cluster_id_table_name)
+    run_stage(stage=get_stage_name(create_crosswalk_cluster_uid_to_cluster_id, db.value, crosswalk_cluster_uid_to_cluster_id_table_name), db=db, run=run,
+              sources=[inspect.getsource(_create_crosswalk_cluster_uid_to_cluster_id), inspect.getsource(get_cluster_year_connected_component_table)], params={},
+              inputs=[(db, intersection_matching_table_name)], outputs=[crosswalk_cluster_uid_to_cluster_id_table_name])
+
+
+def _create_crosswalk_cluster_uid_to_cluster_id(db: DB, intersection_matching_table_name: str, crosswalk_cluster_uid_to_cluster_id_table_name: str) -> None:
     e = get_db_engine(db=db)
 
     with e.connect() as conn:
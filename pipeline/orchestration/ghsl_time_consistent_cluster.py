@@ -1,39 +1,85 @@
+from typing import List
+import functools
+import inspect
+import os
+import rasterio
+from rasterio.windows import Window
 from sqlalchemy import text
-from src.python.utils import execute_bash_script, run_sql_script_on_db, DB, get_db_engine
+from src.python.utils import execute_bash_script, run_sql_script_on_db, run_per_year, run_stage, get_stage_name, DB, get_db_engine
 from src.python.multi_year_matching import get_cluster_year_connected_component_table
+from src.python.connected_components import iter_windows, label_tiles, vectorize_labels
 from common import create_multiyear_table as _create_multiyear_table, create_crosswalk_cluster_uid_to_cluster_id as _create_crosswalk_cluster_uid_to_cluster_id, create_cluster_intersection_matching as _create_cluster_intersection_matching
 from config import config
 
 
-def load_ghsl_rasters():
-    for year in config.param.ghsl.years:
-        _load_ghsl_rasters(year=year)
+def load_ghsl_rasters(years: List[int] = None):
+    run_per_year(_load_ghsl_rasters, years=config.param.ghsl.years if years is None else years, db=DB.GHSL_POSTGRES)
 
 
 def _load_ghsl_rasters(year: int):
     args = [str(year), config.path.source_data.pop.format(year=year), config.path.source_data.smod.format(year=year),
             config.db.ghsl_table.pop.format(year=year), config.db.ghsl_table.smod.format(year=year),
             config.db.postgres_user, config.db.postgres_password, config.db.postgres_host, str(config.db.postgres_port), config.db.ghsl_postgres_db_name]
+    params = {'pop_file_name': config.path.source_data.pop.format(year=year), 'smod_file_name': config.path.source_data.smod.format(year=year)}
+    with open(config.path.bash.ghsl_etl.load_ghsl_rasters) as f:
+        script = f.read()
+
+    run_stage(stage=get_stage_name(_load_ghsl_rasters, year=year), db=DB.GHSL_POSTGRES, run=functools.partial(_run_load_ghsl_rasters, year, args),
+              sources=[script], params=params, inputs=[], outputs=[config.db.ghsl_table.pop.format(year=year), config.db.ghsl_table.smod.format(year=year)])
+
+
+def _run_load_ghsl_rasters(year: int, args: List[str]):
+    # Drop the tables left by a failed load, which raster2pgsql -c would otherwise fail to create
+    e = get_db_engine(db=DB.GHSL_POSTGRES)
+    with e.begin() as conn:
+        conn.execute(text(f"DROP TABLE IF EXISTS {config.db.ghsl_table.pop.format(year=year)}"))
+        conn.execute(text(f"DROP TABLE IF EXISTS {config.db.ghsl_table.smod.format(year=year)}"))
+
     execute_bash_script(file_path=config.path.bash.ghsl_etl.load_ghsl_rasters, args=args)
 
 
-def create_cluster():
-    for year in config.param.ghsl.years:
-        _create_cluster(year=year)
+def create_cluster(years: List[int] = None):
+    run_per_year(_create_cluster, years=config.param.ghsl.years if years is None else years, db=DB.GHSL_POSTGRES, max_workers=config.param.ghsl.cluster_max_workers)
 
 
-@run_sql_script_on_db(db=DB.GHSL_POSTGRES)
 def _create_cluster(year: int):
-    sql_file_path = config.path.sql.ghsl_tcc.create_cluster
     params = {
-        'pop_table': config.db.ghsl_table.pop.format(year=year),
-        'smod_table': config.db.ghsl_table.smod.format(year=year),
-        'cluster_table': config.db.ghsl_table.cluster.format(year=year),
+        'pop_file_name': config.path.source_data.pop.format(year=year),
+        'smod_file_name': config.path.source_data.smod.format(year=year),
         'lower_bound_urban': config.param.ghsl.lower_bound_urban,
-        'dbscan_eps': config.param.ghsl.dbscan_eps,
-        'dbscan_minpoints': config.param.ghsl.dbscan_min_points
+        'cluster_tile_size': config.param.ghsl.cluster_tile_size
     }
-    return sql_file_path, params
+    run_stage(stage=get_stage_name(_create_cluster, year), db=DB.GHSL_POSTGRES, run=functools.partial(_label_cluster, year),
+              sources=[inspect.getsource(_label_cluster), inspect.getsource(label_tiles), inspect.getsource(vectorize_labels)], params=params, inputs=[],
+              outputs=[config.db.ghsl_table.cluster.format(year=year)])
+
+
+def _label_cluster(year: int):
+    # Clusters are the 8-connected components of the urban pixels of smod, i.e. the ones with a class in (lower_bound_urban, 30], and their
+    # population is the sum of pop over their pixels. Both rasters are on the same grid and are read from the source files tile by tile.
+    label_file_path = config.path.cluster_labels.format(dataset='ghsl', year=year)
+    with rasterio.open(config.path.source_data.pop.format(year=year)) as pop, rasterio.open(config.path.source_data.smod.format(year=year)) as smod:
+        assert (pop.height, pop.width, pop.transform) == (smod.height, smod.width, smod.transform), "pop and smod must be on the same grid"
+
+        def tiles():
+            for row_off, col_off, height, width in iter_windows(height=smod.height, width=smod.width, tile_size=config.param.ghsl.cluster_tile_size):
+                window = Window(col_off=col_off, row_off=row_off, width=width, height=height)
+                smod_tile = smod.read(1, window=window)
+                pop_tile = pop.read(1, window=window, masked=True).filled(0)
+                yield row_off, col_off, (smod_tile > config.param.ghsl.lower_bound_urban) & (smod_tile <= 30), pop_tile
+
+        try:
+            labels, population = label_tiles(tiles=tiles(), height=smod.height, width=smod.width, label_file_path=label_file_path)
+            cluster = vectorize_labels(labels=labels, transform=smod.transform, crs=smod.crs, tile_size=config.param.ghsl.cluster_tile_size)
+        finally:
+            if os.path.exists(label_file_path):
+                os.remove(label_file_path)
+
+    cluster['population'] = population[cluster['cluster_id'].values]
+    e = get_db_engine(db=DB.GHSL_POSTGRES)
+    with e.begin() as conn:
+        conn.execute(text(f"DROP TABLE IF EXISTS {config.db.ghsl_table.cluster.format(year=year)}"))
+        cluster[['cluster_id', 'population', 'geom']].to_postgis(name=config.db.ghsl_table.cluster.format(year=year), con=conn, index=False)
 
 
 def create_multiyear_tables_and_cluster_intersection_matching():
@@ -55,7 +101,7 @@ def create_crosswalk_cluster_uid_to_cluster_id() -> None:
                                                 crosswalk_cluster_uid_to_cluster_id_table_name=config.db.ghsl_table.crosswalk_cluster_uid_to_cluster_id)
 
 
-@run_sql_script_on_db(db=DB.GHSL_POSTGRES)
+@run_sql_script_on_db(db=DB.GHSL_POSTGRES, outputs=['time_consistent_cluster_pre_geocoding_table', 'time_consistent_cluster_geometry_pre_geocoding_table'])
 def create_time_consistent_cluster_pre_geocoding():
     sql_file_path = config.path.sql.ghsl_tcc.create_time_consistent_cluster
     params = {
@@ -68,6 +114,15 @@ def create_time_consistent_cluster_pre_geocoding():
 
 
 def load_country_borders():
+    params = {'country_borders_file_name': config.path.source_data.country_borders, 'crosswalk_cshape_to_world_bank_codes_file_name': config.path.source_data.crosswalk_cshape_to_world_bank_codes}
+    with open(config.path.bash.ghsl_etl.load_country_borders) as f:
+        script = f.read()
+
+    run_stage(stage=get_stage_name(load_country_borders), db=DB.GHSL_POSTGRES, run=_load_country_borders, sources=[script], params=params, inputs=[],
+              outputs=[config.db.ghsl_table.country_borders, config.db.ghsl_table.crosswalk_cshape_to_world_bank_codes])
+
+
+def _load_country_borders():
     e = get_db_engine(db=DB.GHSL_POSTGRES)
 
     with e.begin() as conn:
@@ -80,7 +135,7 @@ def load_country_borders():
     execute_bash_script(file_path=config.path.bash.ghsl_etl.load_country_borders, args=args)
 
 
-@run_sql_script_on_db(db=DB.GHSL_POSTGRES)
+@run_sql_script_on_db(db=DB.GHSL_POSTGRES, outputs=['time_consistent_cluster_table', 'time_consistent_cluster_geometry_table'])
 def geocode_cluster_with_country():
     sql_file_path = config.path.sql.ghsl_tcc.country_geocoding
     params = {
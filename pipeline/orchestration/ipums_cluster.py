@@ -1,9 +1,14 @@
+from typing import List
+import functools
+import inspect
+import os
 import numpy as np
 from sqlalchemy import text
 
-from src.python.utils import run_sql_script_on_db, DB, get_db_engine
-from src.python.postgis_raster_io import load_raster, dump_raster
-from src.python.convolution import get_2d_exponential_kernel, convolve2d
+from src.python.utils import run_sql_script_on_db, run_per_year, run_stage, get_stage_name, DB, get_db_engine
+from src.python.postgis_raster_io import get_raster_grid, iter_raster_tiles, dump_raster_tiles
+from src.python.convolution import get_2d_exponential_kernel, convolve2d_tiled
+from src.python.connected_components import iter_windows, label_tiles, vectorize_labels
 from config import config
 
 
@@ -24,61 +29,107 @@ def _create_function__template_usa_raster():
     return sql_file_path, {}
 
 
-def rasterize_census_places():
-    for y in config.param.ipums.years:
-        _rasterize_census_places(y)
+def rasterize_census_places(years: List[int] = None):
+    run_per_year(_rasterize_census_places, years=config.param.ipums.years if years is None else years, db=DB.IPUMS_POSTGRES)
 
 
-@run_sql_script_on_db(db=DB.IPUMS_POSTGRES)
+@run_sql_script_on_db(db=DB.IPUMS_POSTGRES, outputs=['rasterized_census_places_table'])
 def _rasterize_census_places(y: int):
     sql_file_path = config.path.sql.ipums_tcc.rasterize_census_places
     params = {
         'rasterized_census_places_table': config.db.ipums_table.rasterized_census_places.format(year=y),
         'census_place_industry_count_table': config.db.ipums_table.census_place_industry_count.format(year=y),
+        'raster_tile_size': config.param.ipums.raster_tile_size
     }
     return sql_file_path, params
 
 
-def create_convolved_census_place_raster():
-    for y in config.param.ipums.years:
-        _create_convolved_census_place_raster(y)
+def create_convolved_census_place_raster(years: List[int] = None):
+    run_per_year(_create_convolved_census_place_raster, years=config.param.ipums.years if years is None else years, db=DB.IPUMS_POSTGRES)
 
 
 def _create_convolved_census_place_raster(y: int) -> None:
+    params = {'convolution_kernel_size': config.param.ipums.convolution_kernel_size, 'convolution_kernel_decay_rate': config.param.ipums.convolution_kernel_decay_rate,
+              'raster_tile_size': config.param.ipums.raster_tile_size}
+    run_stage(stage=get_stage_name(_create_convolved_census_place_raster, y), db=DB.IPUMS_POSTGRES, run=functools.partial(_convolve_census_place_raster, y),
+              sources=[inspect.getsource(_convolve_census_place_raster), inspect.getsource(get_2d_exponential_kernel), inspect.getsource(convolve2d_tiled)], params=params,
+              inputs=[(DB.IPUMS_POSTGRES, config.db.ipums_table.rasterized_census_places.format(year=y))], outputs=[config.db.ipums_table.convolved_census_place_raster.format(year=y)])
+
+
+def _convolve_census_place_raster(y: int) -> None:
     e = get_db_engine(db=DB.IPUMS_POSTGRES)
 
     # Drop table for idempotency
     with e.begin() as conn:
         conn.execute(text(f"DROP TABLE IF EXISTS {config.db.ipums_table.convolved_census_place_raster.format(year=y)}"))
 
-    with e.begin() as conn:
-        raster = load_raster(con=conn, raster_table=config.db.ipums_table.rasterized_census_places.format(year=y))
-        raster_vals = raster.sel(band=1).values
-
-        kernel = get_2d_exponential_kernel(size=config.param.ipums.convolution_kernel_size, decay_rate=config.param.ipums.convolution_kernel_decay_rate)
-        convolved_raster_vals = convolve2d(image=raster_vals, kernel=kernel)
+    # The raster is streamed tile by tile into a memory-mapped array, which is convolved tile by tile with a halo of the kernel radius, and each
+    # convolved tile is written as it is computed
+    raster_file_path = config.path.raster_memmap.format(raster_table=config.db.ipums_table.rasterized_census_places.format(year=y))
+    try:
+        with e.begin() as conn:
+            grid = get_raster_grid(con=conn, raster_table=config.db.ipums_table.rasterized_census_places.format(year=y))
+            raster_vals = np.lib.format.open_memmap(raster_file_path, mode='w+', dtype=grid.dtype, shape=(grid.height, grid.width))
+            for row_off, col_off, tile in iter_raster_tiles(con=conn, raster_table=config.db.ipums_table.rasterized_census_places.format(year=y), grid=grid):
+                raster_vals[row_off:row_off + tile.shape[1], col_off:col_off + tile.shape[2]] = tile[0]
 
-        convolved_raster = raster.copy(data=np.expand_dims(convolved_raster_vals, axis=0))
-        dump_raster(con=conn, data=convolved_raster, table_name=config.db.ipums_table.convolved_census_place_raster.format(year=y))
+            kernel = get_2d_exponential_kernel(size=config.param.ipums.convolution_kernel_size, decay_rate=config.param.ipums.convolution_kernel_decay_rate)
+            windows = iter_windows(height=grid.height, width=grid.width, tile_size=config.param.ipums.raster_tile_size)
+            convolved_tiles = ((row_off, col_off, np.expand_dims(tile, axis=0)) for row_off, col_off, tile in convolve2d_tiled(image=raster_vals, kernel=kernel, windows=windows))
+            dump_raster_tiles(con=conn, tiles=convolved_tiles, grid=grid._replace(count=1, dtype=np.dtype(np.float64)),
+                              table_name=config.db.ipums_table.convolved_census_place_raster.format(year=y))
+    finally:
+        if os.path.exists(raster_file_path):
+            os.remove(raster_file_path)
 
 
-def create_cluster():
-    for y in config.param.ipums.years:
-        _create_cluster(y)
+def create_cluster(years: List[int] = None):
+    run_per_year(_create_cluster, years=config.param.ipums.years if years is None else years, db=DB.IPUMS_POSTGRES)
 
 
-@run_sql_script_on_db(db=DB.IPUMS_POSTGRES)
 def _create_cluster(y: int):
+    _create_cluster_geometry(y)
+    _create_cluster_from_geometry(y)
+
+
+def _create_cluster_geometry(y: int) -> None:
+    params = {'pixel_threshold': config.param.ipums.pixel_threshold}
+    run_stage(stage=get_stage_name(_create_cluster_geometry, y), db=DB.IPUMS_POSTGRES, run=functools.partial(_label_cluster_geometry, y),
+              sources=[inspect.getsource(_label_cluster_geometry), inspect.getsource(label_tiles), inspect.getsource(vectorize_labels)], params=params,
+              inputs=[(DB.IPUMS_POSTGRES, config.db.ipums_table.convolved_census_place_raster.format(year=y))], outputs=[config.db.ipums_table.cluster_geometry.format(year=y)])
+
+
+def _label_cluster_geometry(y: int) -> None:
+    # Cluster geometries are the 8-connected components of the pixels of the convolved raster above pixel_threshold, labeled tile by tile as the
+    # tiles of the raster are streamed from the database
+    e = get_db_engine(db=DB.IPUMS_POSTGRES)
+    label_file_path = config.path.cluster_labels.format(dataset='ipums', year=y)
+    try:
+        with e.begin() as conn:
+            grid = get_raster_grid(con=conn, raster_table=config.db.ipums_table.convolved_census_place_raster.format(year=y))
+            tiles = ((row_off, col_off, tile[0] > config.param.ipums.pixel_threshold, tile[0])
+                     for row_off, col_off, tile in iter_raster_tiles(con=conn, raster_table=config.db.ipums_table.convolved_census_place_raster.format(year=y), grid=grid))
+            labels, _ = label_tiles(tiles=tiles, height=grid.height, width=grid.width, label_file_path=label_file_path)
+
+        cluster_geometry = vectorize_labels(labels=labels, transform=grid.transform, crs=grid.crs, tile_size=config.param.ipums.raster_tile_size)
+    finally:
+        if os.path.exists(label_file_path):
+            os.remove(label_file_path)
+
+    with e.begin() as conn:
+        conn.execute(text(f"DROP TABLE IF EXISTS {config.db.ipums_table.cluster_geometry.format(year=y)}"))
+        cluster_geometry.to_postgis(name=config.db.ipums_table.cluster_geometry.format(year=y), con=conn, index=False)
+
+
+@run_sql_script_on_db(db=DB.IPUMS_POSTGRES, outputs=['cluster_table', 'cluster_industry_table'])
+def _create_cluster_from_geometry(y: int):
     sql_file_path = config.path.sql.ipums_tcc.create_cluster
     params = {
         'cluster_table': config.db.ipums_table.cluster.format(year=y),
         'cluster_industry_table': config.db.ipums_table.cluster_industry.format(year=y),
         'census_place_industry_count_table': config.db.ipums_table.census_place_industry_count.format(year=y),
-        'convolved_census_place_raster_table': config.db.ipums_table.convolved_census_place_raster.format(year=y),
+        'cluster_geometry_table': config.db.ipums_table.cluster_geometry.format(year=y),
         'census_place_table': config.db.ipums_table.census_place,
-        'industry_table': config.db.ipums_table.industry_code,
-        'dbscan_eps': config.param.ipums.dbscan_eps,
-        'dbscan_minpoints': config.param.ipums.dbscan_min_points,
-        'pixel_threshold': config.param.ipums.pixel_threshold
+        'industry_table': config.db.ipums_table.industry_code
     }
     return sql_file_path, params
\ No newline at end of file
@@ -1,6 +1,10 @@
-import pandas as pd
+import functools
+import inspect
+import os
+import tempfile
+from typing import List
 import sqlalchemy
-from src.python.utils import run_sql_script_on_db, DB, get_db_engine, logger
+from src.python.utils import run_sql_script_on_db, run_per_year, run_stage, get_stage_name, DB, get_db_engine, logger
 from config import config
 
 
@@ -11,13 +15,11 @@ def configure_duckdb():
         conn.execute(sqlalchemy.text("SET enable_progress_bar = false;"))
 
 
-def extract_data_to_duckdb():
-    for y in config.param.ipums.years:
-        logger.debug(f"Extracting data for year {y}")
-        _extract_data_to_duckdb(y)
+def extract_data_to_duckdb(years: List[int] = None):
+    run_per_year(_extract_data_to_duckdb, years=config.param.ipums.years if years is None else years, db=DB.TEMP_DUCKDB)
 
 
-@run_sql_script_on_db(db=DB.TEMP_DUCKDB)
+@run_sql_script_on_db(db=DB.TEMP_DUCKDB, outputs=['dem_table_name', 'geo_table_name'])
 def _extract_data_to_duckdb(y: int):
     sql_file_path = config.path.sql.ipums_etl.extract
     params = {
@@ -29,13 +31,11 @@ def _extract_data_to_duckdb(y: int):
     return sql_file_path, params
 
 
-def transform_data():
-    for y in config.param.ipums.years:
-        logger.debug(f"Transforming data for year {y}")
-        _transform_data(y)
+def transform_data(years: List[int] = None):
+    run_per_year(_transform_data, years=config.param.ipums.years if years is None else years, db=DB.TEMP_DUCKDB)
 
 
-@run_sql_script_on_db(db=DB.TEMP_DUCKDB)
+@run_sql_script_on_db(db=DB.TEMP_DUCKDB, outputs=['census_table_name', 'census_place_industry_count_table_name'])
 def _transform_data(y: int):
     sql_file_path = config.path.sql.ipums_etl.transform
     params = {
@@ -47,13 +47,13 @@ def _transform_data(y: int):
     return sql_file_path, params
 
 
-def load_data_to_postgres():
+def load_data_to_postgres(years: List[int] = None):
     _load_census_place_and_industry_code_tables_to_postgres()
-    for y in config.param.ipums.years:
+    for y in (config.param.ipums.years if years is None else years):
         copy_table_from_duckdb_to_postgres(table_name=config.db.ipums_table.census_place_industry_count.format(year=y))
 
 
-@run_sql_script_on_db(db=DB.IPUMS_POSTGRES)
+@run_sql_script_on_db(db=DB.IPUMS_POSTGRES, outputs=['census_place_table_name', 'industry_code_table_name'])
 def _load_census_place_and_industry_code_tables_to_postgres():
     sql_file_path = config.path.sql.ipums_etl.load
     params = {
@@ -65,13 +65,37 @@ def _load_census_place_and_industry_code_tables_to_postgres():
     return sql_file_path, params
 
 
-def copy_table_from_duckdb_to_postgres(table_name: str, chunksize: int = 10000):
+# DuckDB types without a PostgreSQL equivalent of the same name, the others (INTEGER, BIGINT, DECIMAL(p,s), DATE, ...) are used as they are
+_POSTGRES_TYPES = {'VARCHAR': 'TEXT', 'DOUBLE': 'DOUBLE PRECISION', 'FLOAT': 'REAL', 'TINYINT': 'SMALLINT', 'UTINYINT': 'SMALLINT', 'USMALLINT': 'INTEGER',
+                   'UINTEGER': 'BIGINT', 'UBIGINT': 'NUMERIC', 'HUGEINT': 'NUMERIC'}
+
+
+def copy_table_from_duckdb_to_postgres(table_name: str):
+    run_stage(stage=get_stage_name(copy_table_from_duckdb_to_postgres, table_name), db=DB.IPUMS_POSTGRES, run=functools.partial(_copy_table_from_duckdb_to_postgres, table_name),
+              sources=[inspect.getsource(_copy_table_from_duckdb_to_postgres)], params={}, inputs=[(DB.TEMP_DUCKDB, table_name)], outputs=[table_name])
+
+
+def _copy_table_from_duckdb_to_postgres(table_name: str):
+    # DuckDB writes the table to a CSV file with its parallel writer, which is streamed to COPY FROM STDIN on a single PostgreSQL connection.
+    # The table is created with the DuckDB column types, and dropped, created and filled in one transaction.
     e_duckdb = get_db_engine(db=DB.TEMP_DUCKDB)
     e_postgres = get_db_engine(db=DB.IPUMS_POSTGRES)
 
-    # Drop table for idempotency
-    with e_postgres.begin() as conn:
-        conn.execute(sqlalchemy.text(f'DROP TABLE IF EXISTS {table_name}'))
-
-    for chunk in pd.read_sql_query(f'SELECT * FROM {table_name}', e_duckdb, chunksize=chunksize):
-        chunk.to_sql(table_name, e_postgres, if_exists='append', index=False)
\ No newline at end of file
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_file_path = os.path.join(tmp_dir, f'{table_name}.csv')
+        with e_duckdb.begin() as conn:
+            columns = conn.execute(sqlalchemy.text(f"SELECT column_name, data_type FROM information_schema.columns WHERE table_name = '{table_name}' ORDER BY ordinal_position")).fetchall()
+            conn.execute(sqlalchemy.text(f"COPY \"{table_name}\" TO '{csv_file_path}' (FORMAT CSV, HEADER false)"))
+
+        column_definitions = ', '.join(f'"{name}" {_POSTGRES_TYPES.get(data_type, data_type)}' for name, data_type in columns)
+        conn = e_postgres.raw_connection()
+        try:
+            with conn.cursor() as cursor, open(csv_file_path) as f:
+                cursor.execute(f'DROP TABLE IF EXISTS {table_name}')
+                cursor.execute(f'CREATE TABLE {table_name} ({column_definitions})')
+                cursor.copy_expert(f'COPY {table_name} FROM STDIN WITH (FORMAT csv)', f)
+            conn.commit()
+        finally:
+            conn.close()
+
+    logger.debug(f"Copied {table_name} from DuckDB to PostgreSQL")
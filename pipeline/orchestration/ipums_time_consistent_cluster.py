@@ -20,7 +20,7 @@ def create_crosswalk_cluster_uid_to_cluster_id() -> None:
     _create_crosswalk_cluster_uid_to_cluster_id(db=DB.IPUMS_POSTGRES, intersection_matching_table_name=config.db.ipums_table.cluster_intersection_matching, crosswalk_cluster_uid_to_cluster_id_table_name=config.db.ipums_table.crosswalk_cluster_uid_to_cluster_id)
 
 
-@run_sql_script_on_db(db=DB.IPUMS_POSTGRES)
+@run_sql_script_on_db(db=DB.IPUMS_POSTGRES, outputs=['time_consistent_cluster_table', 'time_consistent_cluster_industry_table', 'time_consistent_cluster_geometry_table'])
 def create_time_consistent_cluster():
     sql_file_path = config.path.sql.ipums_tcc.create_time_consistent_cluster
     params = {
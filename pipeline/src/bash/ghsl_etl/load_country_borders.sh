@@ -1,4 +1,6 @@
 #!/bin/bash
+# Stop at the first failing command, including inside a pipe, so that a failed load exits with a nonzero code
+set -eo pipefail
 
 PATH_COUNTRY_BORDER_DATA=$1
 TABLE_NAME_COUNTRY_BORDER=$2
@@ -11,7 +13,7 @@ POSTGRES_HOST=$7
 POSTGRES_PORT=$8
 POSTGRES_DB=$9
 
-PGPASSWORD="${POSTGRES_PASSWORD}" psql -U "${POSTGRES_USER}" -h "${POSTGRES_HOST}" -p "${POSTGRES_PORT}" -d "${POSTGRES_DB}" -f "${PATH_COUNTRY_BORDER_DATA}"
+PGPASSWORD="${POSTGRES_PASSWORD}" psql -U "${POSTGRES_USER}" -h "${POSTGRES_HOST}" -p "${POSTGRES_PORT}" -d "${POSTGRES_DB}" -v ON_ERROR_STOP=1 -f "${PATH_COUNTRY_BORDER_DATA}"
 PGPASSWORD="${POSTGRES_PASSWORD}" psql -U "${POSTGRES_USER}" -h "${POSTGRES_HOST}" -p "${POSTGRES_PORT}" -d "${POSTGRES_DB}" -c "ALTER TABLE \"CShapes-2.0\" RENAME TO ${TABLE_NAME_COUNTRY_BORDER};"
 
 PGPASSWORD="${POSTGRES_PASSWORD}" psql -U "${POSTGRES_USER}" -h "${POSTGRES_HOST}" -p "${POSTGRES_PORT}" -d "${POSTGRES_DB}" -c"CREATE TABLE ${TABLE_NAME_CROSSWALK_TO_WORLD_BANK_CODES} (cshape_code INTEGER, world_bank_code VARCHAR(3));"
@@ -1,4 +1,6 @@
 #!/bin/bash
+# Stop at the first failing command, including inside a pipe, so that a failed load exits with a nonzero code
+set -eo pipefail
 
 YEAR=$1
 PATH_POP_DATA=$2
@@ -17,7 +19,7 @@ PGPASSWORD="${POSTGRES_PASSWORD}" psql -U "${POSTGRES_USER}" -h "${POSTGRES_HOST
 
 echo "Loading data for year ${YEAR}..."
 
-raster2pgsql -c -C -s 54009 -t auto -Y 1000 -l 2,4,8,16 "${PATH_POP_DATA}" "${TABLE_NAME_POP}" | PGPASSWORD="${POSTGRES_PASSWORD}" psql -U "${POSTGRES_USER}" -h "${POSTGRES_HOST}" -p "${POSTGRES_PORT}" -d "${POSTGRES_DB}"
-raster2pgsql -c -C -s 54009 -t auto -Y 1000 -l 2,4,8,16 "${PATH_SMOD_DATA}" "${TABLE_NAME_SMOD}" | PGPASSWORD="${POSTGRES_PASSWORD}" psql -U "${POSTGRES_USER}" -h "${POSTGRES_HOST}" -p "${POSTGRES_PORT}" -d "${POSTGRES_DB}"
+raster2pgsql -c -C -s 54009 -t auto -Y 1000 -l 2,4,8,16 "${PATH_POP_DATA}" "${TABLE_NAME_POP}" | PGPASSWORD="${POSTGRES_PASSWORD}" psql -U "${POSTGRES_USER}" -h "${POSTGRES_HOST}" -p "${POSTGRES_PORT}" -d "${POSTGRES_DB}" -v ON_ERROR_STOP=1
+raster2pgsql -c -C -s 54009 -t auto -Y 1000 -l 2,4,8,16 "${PATH_SMOD_DATA}" "${TABLE_NAME_SMOD}" | PGPASSWORD="${POSTGRES_PASSWORD}" psql -U "${POSTGRES_USER}" -h "${POSTGRES_HOST}" -p "${POSTGRES_PORT}" -d "${POSTGRES_DB}" -v ON_ERROR_STOP=1
 
 echo "Loading complete for ${YEAR}"
\ No newline at end of file
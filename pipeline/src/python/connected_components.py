@@ -0,0 +1,138 @@
+from typing import Iterable, Iterator, Tuple
+import os
+import tempfile
+from affine import Affine
+import geopandas as gpd
+import numpy as np
+import scipy.ndimage as ndimage
+from rasterio.features import shapes
+from shapely.affinity import affine_transform
+from shapely.geometry import shape
+
+
+# 8-connectivity, i.e. pixels touching by an edge or a corner belong to the same cluster. This is what ST_ClusterDBSCAN gives on the pixel
+# polygons with minpoints 1 and an eps smaller than the pixel size.
+_STRUCTURE = np.ones((3, 3), dtype=bool)
+
+
+class UnionFind:
+    def __init__(self, n: int):
+        self.parent = np.arange(n)
+
+    def find(self, x: int) -> int:
+        while self.parent[x] != x:
+            self.parent[x] = self.parent[self.parent[x]]
+            x = self.parent[x]
+        return x
+
+    def union(self, x: int, y: int) -> None:
+        rx, ry = self.find(x), self.find(y)
+        if rx != ry:
+            self.parent[max(rx, ry)] = min(rx, ry)
+
+    def roots(self) -> np.ndarray:
+        parent = self.parent
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                return parent
+            parent = grandparent
+
+
+def iter_windows(height: int, width: int, tile_size: int) -> Iterator[Tuple[int, int, int, int]]:
+    # (row_off, col_off, tile_height, tile_width) of the tiles covering a height x width grid
+    for row_off in range(0, height, tile_size):
+        for col_off in range(0, width, tile_size):
+            yield row_off, col_off, min(tile_size, height - row_off), min(tile_size, width - col_off)
+
+
+def label_tiles(tiles: Iterable[Tuple[int, int, np.ndarray, np.ndarray]], height: int, width: int, label_file_path: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    8-connected component labeling of a height x width grid, given tile by tile. Besides the labels, which are memory-mapped,
+    only one tile, or one row or column of the grid along a tile border, is in memory at once.
+
+    Parameters:
+    - tiles: (row_off, col_off, mask, values) for each tile, where mask is True on the pixels to cluster and values are
+      summed over each cluster (e.g. the population of each pixel)
+    - label_file_path: .npy file in which the labels are memory-mapped
+
+    Returns:
+    - The int32 labels of the grid, 0 outside the mask and 1 to n_clusters inside
+    - The sum of values over each cluster, indexed by label (index 0 being the pixels outside the mask)
+    """
+    labels = np.lib.format.open_memmap(label_file_path, mode='w+', dtype=np.int32, shape=(height, width))
+    sums, n_labels = [np.zeros(1)], 0
+    windows, row_offs, col_offs = [], set(), set()
+    for row_off, col_off, mask, values in tiles:
+        tile_labels, n = ndimage.label(mask, structure=_STRUCTURE, output=np.int32)
+        sums.append(np.bincount(tile_labels.ravel(), weights=np.where(mask, values, 0).ravel(), minlength=n + 1)[1:])
+        tile_labels[mask] += n_labels
+        labels[row_off:row_off + mask.shape[0], col_off:col_off + mask.shape[1]] = tile_labels
+        windows.append((row_off, col_off, mask.shape[0], mask.shape[1]))
+        row_offs.add(row_off)
+        col_offs.add(col_off)
+        n_labels += n
+
+    # Stitch the clusters cut by the tile borders, comparing each border row (column) with its neighbours above (left), diagonals included
+    uf = UnionFind(n_labels + 1)
+    borders = [(labels[r - 1], labels[r]) for r in sorted(row_offs) if r > 0] + [(labels[:, c - 1], labels[:, c]) for c in sorted(col_offs) if c > 0]
+    for before, after in borders:
+        before, after = np.asarray(before), np.asarray(after)
+        pairs = np.concatenate([np.stack([before, after], axis=1), np.stack([before[:-1], after[1:]], axis=1), np.stack([before[1:], after[:-1]], axis=1)])
+        pairs = pairs[(pairs[:, 0] > 0) & (pairs[:, 1] > 0) & (pairs[:, 0] != pairs[:, 1])]
+        for x, y in np.unique(pairs, axis=0):
+            uf.union(x, y)
+
+    # Relabel with consecutive labels, the roots keeping the order of the tiles and 0 mapping to 0
+    _, final_labels = np.unique(uf.roots(), return_inverse=True)
+    final_labels = final_labels.astype(np.int32)
+    for row_off, col_off, tile_height, tile_width in windows:
+        tile = labels[row_off:row_off + tile_height, col_off:col_off + tile_width]
+        tile[...] = final_labels[tile]
+
+    labels.flush()
+    return labels, np.bincount(final_labels, weights=np.concatenate(sums))
+
+
+def vectorize_labels(labels: np.ndarray, transform: Affine, crs, tile_size: int) -> gpd.GeoDataFrame:
+    # The labels are vectorized tile by tile, so that a single tile of a memory-mapped grid is read at once, and the pieces of each cluster are
+    # merged. The pieces are in pixel coordinates, which are integers and so match exactly along the tile borders, and are only then transformed.
+    # They are 4-connected, as 8-connected polygonization gives rings touching themselves at the corners between diagonal pixels, which are
+    # invalid. The labels already hold the 8-connected clusters, whose diagonal pieces the dissolve merges into a valid MultiPolygon.
+    polygons = []
+    for row_off, col_off, tile_height, tile_width in iter_windows(height=labels.shape[0], width=labels.shape[1], tile_size=tile_size):
+        tile = np.asarray(labels[row_off:row_off + tile_height, col_off:col_off + tile_width])
+        polygons += [(int(value), shape(geom)) for geom, value in shapes(tile, mask=tile > 0, connectivity=4, transform=Affine.translation(col_off, row_off))]
+
+    clusters = gpd.GeoDataFrame([{'cluster_id': cluster_id, 'geom': geom} for cluster_id, geom in polygons], geometry='geom', crs=crs)
+    clusters = clusters.dissolve(by='cluster_id').reset_index()
+    clusters['geom'] = clusters['geom'].apply(affine_transform, matrix=transform.to_shapely())
+    return clusters
+
+
+def check_vectorize_labels(tile_size: int = 4) -> None:
+    # Clusters connected only by the corners of their pixels, across the seams between tiles, must each give one valid geometry covering their pixels
+    mask = np.zeros((3 * tile_size, 3 * tile_size), dtype=bool)
+    diagonal = np.arange(tile_size // 2, 2 * tile_size + tile_size // 2)
+    mask[diagonal, diagonal] = True
+    mask[tile_size - 1, 2 * tile_size + 1], mask[tile_size, 2 * tile_size + 2] = True, True
+    transform = Affine(100, 0, 1000, 0, -100, 5000)
+
+    def tiles():
+        for row_off, col_off, height, width in iter_windows(height=mask.shape[0], width=mask.shape[1], tile_size=tile_size):
+            tile = mask[row_off:row_off + height, col_off:col_off + width]
+            yield row_off, col_off, tile, np.ones(tile.shape)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        labels, population = label_tiles(tiles=tiles(), height=mask.shape[0], width=mask.shape[1], label_file_path=os.path.join(tmp_dir, 'labels.npy'))
+        clusters = vectorize_labels(labels=labels, transform=transform, crs=None, tile_size=tile_size)
+        whole_grid = vectorize_labels(labels=labels, transform=transform, crs=None, tile_size=max(mask.shape))
+        labels = np.array(labels)
+
+    assert labels.max() == 2 and list(population[1:]) == [len(diagonal), 2], 'The diagonal clusters are not stitched across the tile seams'
+    assert list(clusters['cluster_id']) == [1, 2] and clusters.is_valid.all(), 'Each cluster must give a single valid geometry'
+    assert np.allclose(clusters.area, whole_grid.area) and np.allclose(clusters.area, np.bincount(labels.ravel())[1:] * 100 ** 2), 'The cluster areas differ from those of their pixels'
+
+
+if __name__ == '__main__':
+    check_vectorize_labels()
@@ -1,3 +1,4 @@
+from typing import Iterable, Iterator, Tuple
 import scipy.ndimage as ndimage
 import numpy as np
 
@@ -25,5 +26,26 @@ def convolve2d(image, kernel):
     return ndimage.convolve(image, kernel, mode='constant', cval=0.0)
 
 
+def convolve2d_tiled(image: np.ndarray, kernel: np.ndarray, windows: Iterable[Tuple[int, int, int, int]]) -> Iterator[Tuple[int, int, np.ndarray]]:
+    """
+    Convolve an image tile by tile, e.g. a memory-mapped one, with the same result as convolve2d on the whole image
+
+    Parameters:
+    - image: 2D array, only a tile and its halo of the kernel radius being read at once
+    - kernel: 2D kernel with odd sizes
+    - windows: (row_off, col_off, tile_height, tile_width) of the tiles
+
+    Returns:
+    - An iterator over (row_off, col_off, convolved tile)
+    """
+    radius_y, radius_x = kernel.shape[0] // 2, kernel.shape[1] // 2
+    height, width = image.shape
+    for row_off, col_off, tile_height, tile_width in windows:
+        top, left = max(row_off - radius_y, 0), max(col_off - radius_x, 0)
+        bottom, right = min(row_off + tile_height + radius_y, height), min(col_off + tile_width + radius_x, width)
+        convolved = convolve2d(image=np.asarray(image[top:bottom, left:right]), kernel=kernel)
+        yield row_off, col_off, convolved[row_off - top:row_off - top + tile_height, col_off - left:col_off - left + tile_width]
+
+
 if __name__ == '__main__':
     print(get_2d_exponential_kernel(5, 0.5))
\ No newline at end of file
@@ -0,0 +1,59 @@
+from typing import Any, Dict, List, Optional
+import hashlib
+import json
+import os
+import threading
+
+
+class Manifest:
+    """
+    JSON record of the pipeline stages that have run. A stage is identified by its name and arguments, and recorded with
+    the hash of what defines it: its sources (SQL template, Python code), its parameters, the fingerprints of its input
+    files and tables. Each table it creates is fingerprinted with that same hash, so that a change anywhere upstream
+    changes the hash of every stage downstream of it.
+    """
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self._lock = threading.Lock()
+        if os.path.exists(file_path):
+            with open(file_path) as f:
+                self._entries = json.load(f)
+        else:
+            self._entries = {'stages': {}, 'tables': {}}
+
+    def table_fingerprint(self, db: str, table: str) -> Optional[str]:
+        return self._entries['tables'].get(f'{db}.{table}')
+
+    def stage_hash(self, sources: List[str], params: Dict[str, Any], inputs: List[Optional[str]]) -> str:
+        h = hashlib.sha256()
+        for source in sources:
+            h.update(source.encode())
+        h.update(json.dumps(params, sort_keys=True, default=str).encode())
+        h.update(json.dumps(inputs).encode())
+        return h.hexdigest()
+
+    def is_recorded(self, stage: str, stage_hash: str) -> bool:
+        return self._entries['stages'].get(stage) == stage_hash
+
+    def record(self, stage: str, stage_hash: str, db: str, outputs: List[str]) -> None:
+        # Stages of the same step run in parallel threads, and the file is replaced atomically so that an interrupted run never leaves it truncated
+        with self._lock:
+            self._entries['stages'][stage] = stage_hash
+            for table in outputs:
+                self._entries['tables'][f'{db}.{table}'] = stage_hash
+
+            os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+            tmp_file_path = f'{self.file_path}.tmp'
+            with open(tmp_file_path, 'w') as f:
+                json.dump(self._entries, f, indent=2, sort_keys=True)
+            os.replace(tmp_file_path, self.file_path)
+
+
+def file_fingerprint(file_path: str) -> Optional[List[int]]:
+    # Size and modification time, as hashing the multi-GB source files on every run would cost as much as some of the stages.
+    # Files that are not visible from here, e.g. the ones read by the database server inside its container, have no fingerprint.
+    if not os.path.exists(file_path):
+        return None
+
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime_ns]
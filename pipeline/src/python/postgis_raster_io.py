@@ -1,12 +1,69 @@
+from typing import Iterable, Iterator, NamedTuple, Tuple
+import numpy as np
+from affine import Affine
+from rasterio.crs import CRS
 from rasterio.io import MemoryFile
 import rioxarray as riox
 import xarray as xr
 import sqlalchemy
 
 
+# PostGIS band pixel types and the corresponding numpy types
+_PIXEL_TYPES = {'1BB': 'uint8', '2BUI': 'uint8', '4BUI': 'uint8', '8BSI': 'int8', '8BUI': 'uint8', '16BSI': 'int16', '16BUI': 'uint16',
+                '32BSI': 'int32', '32BUI': 'uint32', '32BF': 'float32', '64BF': 'float64'}
+
+
+class RasterGrid(NamedTuple):
+    # Grid covered by all the tiles of a PostGIS raster table
+    height: int
+    width: int
+    count: int
+    dtype: np.dtype
+    transform: Affine
+    crs: CRS
+    nodata: float
+
+
+def get_raster_grid(con: sqlalchemy.engine.Connection, raster_table: str, raster_column: str = 'rast') -> RasterGrid:
+    """
+    Get the grid of a PostGIS raster, stored as a single raster or as tiles (e.g. by raster2pgsql -t or ST_Tile), which
+    must share the same scale, SRID and band types and have no skew.
+    """
+    res = con.execute(sqlalchemy.text(f"""
+    SELECT MIN(ST_UpperLeftX({raster_column})), MAX(ST_UpperLeftY({raster_column})),
+           MAX(ST_UpperLeftX({raster_column}) + ST_Width({raster_column}) * ST_ScaleX({raster_column})),
+           MIN(ST_UpperLeftY({raster_column}) + ST_Height({raster_column}) * ST_ScaleY({raster_column})),
+           MIN(ST_ScaleX({raster_column})), MIN(ST_ScaleY({raster_column})), MIN(ST_SRID({raster_column})), MIN(ST_NumBands({raster_column})),
+           MIN(ST_BandNoDataValue({raster_column}, 1)), MIN(ST_BandPixelType({raster_column}, 1))
+    FROM {raster_table}
+    """))
+    min_x, max_y, max_x, min_y, scale_x, scale_y, srid, count, nodata, pixel_type = res.fetchone()
+    return RasterGrid(height=int(round((min_y - max_y) / scale_y)), width=int(round((max_x - min_x) / scale_x)), count=count, dtype=np.dtype(_PIXEL_TYPES[pixel_type]),
+                      transform=Affine(scale_x, 0, min_x, 0, scale_y, max_y), crs=CRS.from_epsg(srid), nodata=nodata)
+
+
+def iter_raster_tiles(con: sqlalchemy.engine.Connection, raster_table: str, grid: RasterGrid, raster_column: str = 'rast') -> Iterator[Tuple[int, int, np.ndarray]]:
+    """
+    Iterate over the tiles of a PostGIS raster, fetched one at a time from a server-side cursor, so that memory is bounded
+    by the size of a tile whatever the size of the raster.
+
+    Yields:
+    - (row_off, col_off, values) for each tile, values being a (bands, height, width) array at [row_off, col_off] in grid
+    """
+    # The option is set on the statement rather than on con, which would make every later statement on con use a server-side cursor
+    query = sqlalchemy.text(f"SELECT ST_AsGDALRaster({raster_column}, 'GTIff') FROM {raster_table}").execution_options(stream_results=True)
+    res = con.execute(query)
+    for tile in res:
+        with MemoryFile(bytes(tile[0])) as memory_file, memory_file.open() as dataset:
+            values = dataset.read()
+            col_off, row_off = ~grid.transform * (dataset.transform.c, dataset.transform.f)
+
+        yield int(round(row_off)), int(round(col_off)), values
+
+
 def load_raster(con: sqlalchemy.engine.Connection, raster_table: str, raster_column: str = 'rast') -> xr.DataArray:
     """
-    Load a specific a PostGIS raster into a rioxarray DataArray
+    Load a specific a PostGIS raster into a rioxarray DataArray, mosaicking its tiles if it is tiled
 
     Parameters:
     - conn: psycopg2 connection object to the database
@@ -16,12 +73,15 @@ def load_raster(con: sqlalchemy.engine.Connection, raster_table: str, raster_col
     Returns:
     - A rioxarray DataArray object representing the raster
     """
-
-    res = con.execute(sqlalchemy.text(f"SELECT ST_AsGDALRaster({raster_column}, 'GTIff') FROM {raster_table}"))
-    raster = res.fetchone()
-
-    in_memory_raster = MemoryFile(bytes(raster[0]))
-    raster_dataset = riox.open_rasterio(in_memory_raster)
+    grid = get_raster_grid(con=con, raster_table=raster_table, raster_column=raster_column)
+    values = np.full((grid.count, grid.height, grid.width), 0 if grid.nodata is None else grid.nodata, dtype=grid.dtype)
+    for row_off, col_off, tile in iter_raster_tiles(con=con, raster_table=raster_table, grid=grid, raster_column=raster_column):
+        values[:, row_off:row_off + tile.shape[1], col_off:col_off + tile.shape[2]] = tile
+
+    x = grid.transform.c + (np.arange(grid.width) + 0.5) * grid.transform.a
+    y = grid.transform.f + (np.arange(grid.height) + 0.5) * grid.transform.e
+    raster_dataset = xr.DataArray(values, dims=('band', 'y', 'x'), coords={'band': np.arange(grid.count) + 1, 'y': y, 'x': x})
+    raster_dataset = raster_dataset.rio.write_crs(grid.crs).rio.write_transform(grid.transform).rio.write_nodata(grid.nodata)
     return raster_dataset
 
 
@@ -40,22 +100,36 @@ def dump_raster(con: sqlalchemy.engine.Connection, data: xr.DataArray, table_nam
     assert data.rio.transform() is not None, "The input data must have a transform"
 
     raster_array = data.rio
-    width, height = raster_array.width, raster_array.height
-    bands = raster_array.count
-    srid = raster_array.crs.to_epsg()
-    nodata = raster_array.nodata
-    with MemoryFile() as memory_file:
-        with memory_file.open(driver='GTiff', width=width, height=height, count=bands, dtype=raster_array._obj.dtype, crs=f'EPSG:{srid}', transform=raster_array.transform(), nodata=nodata) as dataset:
-            dataset.write(data)
-
-        geotiff_data = memory_file.read()
-
-    con.execute(sqlalchemy.text(f"CREATE TABLE {table_name} (rast raster);"))
-    con.execute(sqlalchemy.text(f"INSERT INTO {table_name} (rast) VALUES (ST_FromGDALRaster(:data))"), {'data': geotiff_data})
-    con.execute(sqlalchemy.text(f"SELECT AddRasterConstraints('{table_name}'::name, 'rast'::name);"))
+    grid = RasterGrid(height=raster_array.height, width=raster_array.width, count=raster_array.count, dtype=raster_array._obj.dtype,
+                      transform=raster_array.transform(), crs=raster_array.crs, nodata=raster_array.nodata)
+    dump_raster_tiles(con=con, tiles=[(0, 0, data.values)], grid=grid, table_name=table_name)
     con.commit()
 
 
+def dump_raster_tiles(con: sqlalchemy.engine.Connection, tiles: Iterable[Tuple[int, int, np.ndarray]], grid: RasterGrid, table_name: str):
+    """
+    Dump tiles into a PostGIS raster table, one row per tile, encoding a single tile at a time
+
+    :param con: psycopg2 connection object to the database
+    :param tiles: (row_off, col_off, values) for each tile, values being a (bands, height, width) array at [row_off, col_off] in grid
+    :param grid: grid of the raster, whose dtype, CRS and nodata are those of the tiles
+    :param table_name: Name of the table to store the raster (it must not exist)
+    :return: None
+    """
+    con.execute(sqlalchemy.text(f"CREATE TABLE {table_name} (rid serial PRIMARY KEY, rast raster);"))
+    for row_off, col_off, values in tiles:
+        with MemoryFile() as memory_file:
+            with memory_file.open(driver='GTiff', width=values.shape[2], height=values.shape[1], count=values.shape[0], dtype=grid.dtype, crs=f'EPSG:{grid.crs.to_epsg()}',
+                                  transform=grid.transform * Affine.translation(col_off, row_off), nodata=grid.nodata) as dataset:
+                dataset.write(values.astype(grid.dtype, copy=False))
+
+            geotiff_data = memory_file.read()
+
+        con.execute(sqlalchemy.text(f"INSERT INTO {table_name} (rast) VALUES (ST_FromGDALRaster(:data))"), {'data': geotiff_data})
+
+    con.execute(sqlalchemy.text(f"SELECT AddRasterConstraints('{table_name}'::name, 'rast'::name);"))
+
+
 if __name__ == '__main__':
     from utils import get_db_engine, DB
 
@@ -64,5 +138,3 @@ if __name__ == '__main__':
         raster = load_raster(conn, 'rasterized_census_places_1850')
         print(raster)
         dump_raster(conn, raster, 'rasterized_census_places_1850_copy')
-
-
@@ -1,12 +1,14 @@
-from typing import Dict, List
+from typing import Any, Callable, Dict, List, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import subprocess
 import os
 from enum import Enum
-from sqlalchemy import create_engine, text, MetaData, Table
+from sqlalchemy import create_engine, inspect, text, MetaData, Table
 import functools
 import jinja2
 import logging
 from config import config
+from src.python.manifest import Manifest, file_fingerprint
 
 
 logger = logging.getLogger('cluster_pipeline')
@@ -17,10 +19,11 @@ ch.setFormatter(formatter)
 logger.addHandler(ch)
 
 engine_temp_duckdb = create_engine(config.db.temp_duckdb_uri, echo=True if config.debug else False)
-engine_ipums_postgres = create_engine(config.db.ipums_postgres_uri, echo=True if config.debug else False)
+engine_ipums_postgres = create_engine(config.db.ipums_postgres_uri, echo=True if config.debug else False, pool_size=config.db.max_workers['clusterdb_postgres'])
 metadata_ipums_postgres = MetaData()
-engine_ghsl_postgres = create_engine(config.db.ghsl_postgres_uri, echo=True if config.debug else False)
+engine_ghsl_postgres = create_engine(config.db.ghsl_postgres_uri, echo=True if config.debug else False, pool_size=config.db.max_workers['ghsl_postgres'])
 metadata_ghsl_postgres = MetaData()
+manifest = Manifest(file_path=config.path.manifest)
 
 
 class DB(Enum):
@@ -29,21 +32,79 @@ class DB(Enum):
     GHSL_POSTGRES = 'ghsl_postgres'
 
 
-def run_sql_script_on_db(db: DB):
+def run_sql_script_on_db(db: DB, outputs: List[str] = ()):
+    # outputs are the keys of params naming the tables created by the script, the other params ending in _table or _table_name being its input tables.
+    # The script is run through run_stage, so that it is skipped when nothing it depends on has changed since its last run.
     def decorator_run_sql_script_on_db(func):
         @functools.wraps(func)
         def wrapper_sql_script_on_db(*args, **kwargs):
             e = get_db_engine(db)
             sql_file_path, params = func(*args, **kwargs)
-            with e.begin() as conn:
-                execute_sql_file(conn=conn,
-                                 file_path=sql_file_path,
-                                 params=params)
+            with open(sql_file_path) as f:
+                sql = f.read()
+
+            def run():
+                with e.begin() as conn:
+                    execute_sql_file(conn=conn,
+                                     file_path=sql_file_path,
+                                     params=params)
+
+            inputs = [(db, table) for name, table in params.items() if name.endswith(('_table', '_table_name')) and name not in outputs]
+            run_stage(stage=get_stage_name(func, *args, **kwargs), db=db, run=run, sources=[sql], params=params, inputs=inputs, outputs=[params[name] for name in outputs])
 
         return wrapper_sql_script_on_db
     return decorator_run_sql_script_on_db
 
 
+def run_stage(stage: str, db: DB, run: Callable[[], Any], sources: List[str], params: Dict[str, Any], inputs: List[Tuple[DB, str]], outputs: List[str]) -> None:
+    """
+    Run a pipeline stage which creates the tables outputs on db, unless the manifest shows that it already ran with the
+    same sources, params, input files (the params ending in _file_name) and input tables, and its outputs still exist. A
+    stage without outputs is not tracked and always runs.
+    """
+    if not outputs:
+        run()
+        return
+
+    files = [file_fingerprint(path) for name, path in sorted(params.items()) if name.endswith('_file_name')]
+    tables = [manifest.table_fingerprint(db=input_db.value, table=table) for input_db, table in inputs]
+    stage_hash = manifest.stage_hash(sources=sources, params=params, inputs=files + tables)
+    if manifest.is_recorded(stage=stage, stage_hash=stage_hash) and all(inspect(get_db_engine(db)).has_table(table) for table in outputs):
+        logger.info(f"Skipping {stage}, nothing it depends on has changed")
+        return
+
+    run()
+    manifest.record(stage=stage, stage_hash=stage_hash, db=db.value, outputs=outputs)
+
+
+def get_stage_name(func: Callable, *args, **kwargs) -> str:
+    arguments = [repr(arg) for arg in args] + [f'{name}={value!r}' for name, value in sorted(kwargs.items())]
+    return f"{func.__module__}.{func.__qualname__}({', '.join(arguments)})"
+
+
+def run_per_year(task: Callable[[int], Any], years: List[int], db: DB, max_workers: int = None) -> None:
+    """
+    Run the independent tasks task(year) of a stage concurrently, at most config.db.max_workers of them at once on db, or
+    max_workers for the stages whose work is done in this process rather than by the database. Each task checks out its
+    own connection from the pool of the engine. A failed task is logged without stopping the others, and a RuntimeError
+    listing the failed years is raised once all the tasks are done.
+    """
+    failed = {}
+    with ThreadPoolExecutor(max_workers=config.db.max_workers[db.value] if max_workers is None else max_workers) as executor:
+        futures = {executor.submit(task, year): year for year in years}
+        for future in as_completed(futures):
+            year = futures[future]
+            try:
+                future.result()
+                logger.debug(f"{task.__name__} done for year {year}")
+            except Exception as e:
+                logger.exception(f"{task.__name__} failed for year {year}")
+                failed[year] = e
+
+    if failed:
+        raise RuntimeError(f"{task.__name__} failed for years {sorted(failed)}") from next(iter(failed.values()))
+
+
 def get_db_engine(db: DB):
     if db == DB.TEMP_DUCKDB:
         return engine_temp_duckdb
@@ -97,6 +158,8 @@ def execute_bash_script(file_path: str, args: List[str]):
     if err:
         print("stderr:", err.strip())
 
-    # Print the return code
+    # Print the return code, and raise if the script failed so that the stage running it is not recorded as done
     print("Return code:", process.returncode)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(returncode=process.returncode, cmd=[file_path] + args, stderr=err)
 
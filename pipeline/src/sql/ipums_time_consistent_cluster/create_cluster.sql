@@ -1,32 +1,11 @@
 DROP TABLE IF EXISTS "{{ params.cluster_industry_table }}";
 DROP TABLE IF EXISTS "{{ params.cluster_table }}";
 
--- Create a temporary table to store the cluster geometries
-CREATE TEMPORARY TABLE cluster_geom_tmp ON COMMIT DROP AS
-WITH pixels AS (
-        SELECT (ST_PixelAsPolygons(rast, 1, TRUE)).*
-        FROM "{{ params.convolved_census_place_raster_table }}"
-    ),
-    filtered_pixel AS (
-        SELECT val, geom
-        FROM pixels
-        WHERE val > {{ params.pixel_threshold }}
-    ),
-    dbscan AS (
-        SELECT ST_ClusterDBSCAN(geom, eps := {{ params.dbscan_eps }}, minpoints := {{ params.dbscan_minpoints }}) OVER () AS cid, geom, val
-        FROM filtered_pixel
-    )
-SELECT cid AS cluster_id, ST_Union(geom) AS geom
-FROM dbscan
-GROUP BY cid;
-
-CREATE INDEX ON cluster_geom_tmp USING GIST (geom);
-
 -- Create a temporary table to store the cluster to census place crosswalk
 CREATE TEMPORARY TABLE cluster_census_place_crosswalk ON COMMIT DROP AS
 SELECT id AS census_place_id, cluster_id
-FROM cluster_geom_tmp JOIN "{{ params.census_place_table }}"
-ON ST_Within(ST_Transform("{{ params.census_place_table }}".geom::geometry, 5070), cluster_geom_tmp.geom);
+FROM "{{ params.cluster_geometry_table }}" JOIN "{{ params.census_place_table }}"
+ON ST_Within(ST_Transform("{{ params.census_place_table }}".geom::geometry, 5070), "{{ params.cluster_geometry_table }}".geom);
 
 -- Create a temporary table to store the cluster population
 CREATE TEMPORARY TABLE cluster_pop_tmp ON COMMIT DROP AS
@@ -42,9 +21,9 @@ GROUP BY cluster_id;
 
 -- Create the cluster table
 CREATE TABLE "{{ params.cluster_table }}" AS
-SELECT cluster_geom_tmp.cluster_id, population, geom
-FROM cluster_geom_tmp JOIN cluster_pop_tmp
-ON cluster_geom_tmp.cluster_id = cluster_pop_tmp.cluster_id;
+SELECT "{{ params.cluster_geometry_table }}".cluster_id, population, geom
+FROM "{{ params.cluster_geometry_table }}" JOIN cluster_pop_tmp
+ON "{{ params.cluster_geometry_table }}".cluster_id = cluster_pop_tmp.cluster_id;
 
 CREATE INDEX ON "{{ params.cluster_table }}" USING GIST (geom);
 ALTER TABLE "{{ params.cluster_table }}" ADD PRIMARY KEY (cluster_id);
@@ -1,5 +1,6 @@
 --- Create a raster with one band
 --- Each pixel has value equal to the sum of the population of the census places inside that pixel
+--- The raster is stored in tiles of raster_tile_size pixels, so that it can be read tile by tile
 DROP TABLE IF EXISTS "{{ params.rasterized_census_places_table }}";
 
 CREATE TABLE "{{ params.rasterized_census_places_table }}" AS
@@ -22,7 +23,7 @@ WITH usa_raster AS (
        SELECT ARRAY_AGG((ST_Transform(geom::geometry, 5070), pop_count::float)::geomval) AS geomvalset
        FROM census_place_pop
    )
-SELECT ST_SetValues(usa_raster.rast, 1, census_places_geomval.geomvalset, FALSE) AS rast
+SELECT ST_Tile(ST_SetValues(usa_raster.rast, 1, census_places_geomval.geomvalset, FALSE), {{ params.raster_tile_size }}, {{ params.raster_tile_size }}) AS rast
 FROM census_places_geomval
 CROSS JOIN usa_raster;
 